@@ -15,7 +15,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     version="0.4.0",
-    py_modules=["vimwiki_markdown"],
+    py_modules=["vimwiki_markdown", "vimwiki_markdown_client"],
     packages=[],
     package_data={},
     license="MIT License",
@@ -23,7 +23,10 @@ setup(
     author_email="steeve" "@" "chailloux.me",
     url="https://github.com/WnP/vimwiki_markdown/",
     entry_points={
-        "console_scripts": [["vimwiki_markdown = vimwiki_markdown:main"]]
+        "console_scripts": [
+            "vimwiki_markdown = vimwiki_markdown:main",
+            "vimwiki_markdown_client = vimwiki_markdown_client:main",
+        ]
     },
     install_requires=["markdown", "Pygments"],
     extras_require={},
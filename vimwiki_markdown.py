@@ -1,17 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import abc
 import argparse
+import contextlib
 import datetime
+import hashlib
+import importlib
+import io
+import locale
 import os
+import posixpath
+import re
 import shutil
-import subprocess
+import stat
 import sys
 import json
 import textwrap
-import markdown
-from typing import Dict, Tuple, Optional
+import time
+
+# markdown, pygments, sqlite3 and the multiprocessing and server modules are
+# imported where they are used, most runs need only some of them
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Set, Tuple, Optional
+from html import escape as escape_html, unescape as unescape_html
 from pathlib import Path
 
+if TYPE_CHECKING:
+    import concurrent.futures
+
 
 #******************************************************************************
 #
@@ -213,6 +230,109 @@ img {
 """
 
 
+#******************************************************************************
+#
+#******************************************************************************
+search_js = r"""// search client for the index written by vimwiki_markdown, see the search_index option.
+// include it with <script src="%root_path%search/search.js"></script> after an
+// <input id="vimwiki-search"> and a <ul id="vimwiki-search-results">.
+(function () {
+    var base = document.currentScript.src.replace(/[^\/]*$/, '');
+    var root = base.replace(/search\/$/, '');
+    var shards = {};
+    var docs = null;
+
+    function fetchJson(url) {
+        return fetch(url).then(function (r) { return r.ok ? r.json() : {}; });
+    }
+
+    function shardKey(term) {
+        var bytes = new TextEncoder().encode(Array.from(term).slice(0, 2).join(''));
+        return Array.from(bytes, function (b) { return b.toString(16).padStart(2, '0'); }).join('');
+    }
+
+    function shard(term) {
+        var key = shardKey(term);
+        if (!(key in shards)) {
+            shards[key] = fetchJson(base + key + '.json');
+        }
+        return shards[key];
+    }
+
+    function tokens(text) {
+        return text.toLowerCase().match(/[\p{L}\p{N}_]{2,}/gu) || [];
+    }
+
+    // pages holding every term, the last term also matches as a prefix
+    function search(query) {
+        var terms = tokens(query);
+        if (!terms.length) {
+            return Promise.resolve([]);
+        }
+        docs = docs || fetchJson(base + 'docs.json');
+        return Promise.all([docs].concat(terms.map(shard))).then(function (loaded) {
+            var pages = loaded[0].pages || {};
+            var count = loaded[0].count || 1;
+            var scores = null;
+            terms.forEach(function (term, i) {
+                var index = loaded[i + 1];
+                var last = i === terms.length - 1;
+                var found = {};
+                Object.keys(index).forEach(function (t) {
+                    if (t === term || (last && t.startsWith(term))) {
+                        var idf = Math.log(1 + count / index[t].length);
+                        index[t].forEach(function (p) { found[p[0]] = (found[p[0]] || 0) + p[1] * idf; });
+                    }
+                });
+                if (scores !== null) {
+                    var both = {};
+                    Object.keys(found).forEach(function (id) {
+                        if (id in scores) { both[id] = found[id] + scores[id]; }
+                    });
+                    found = both;
+                }
+                scores = found;
+            });
+            return Object.keys(scores)
+                .filter(function (id) { return id in pages; })
+                .sort(function (a, b) { return scores[b] - scores[a]; })
+                .slice(0, 50)
+                .map(function (id) { return {url: root + pages[id][0], title: pages[id][1], score: scores[id]}; });
+        });
+    }
+
+    window.vimwikiSearch = search;
+
+    var input = document.getElementById('vimwiki-search');
+    var list = document.getElementById('vimwiki-search-results');
+    if (!input || !list) {
+        return;
+    }
+    var timer = null;
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var query = input.value;
+            search(query).then(function (results) {
+                if (input.value !== query) {
+                    return;
+                }
+                list.textContent = '';
+                results.forEach(function (result) {
+                    var a = document.createElement('a');
+                    a.href = result.url;
+                    a.textContent = result.title;
+                    var li = document.createElement('li');
+                    li.appendChild(a);
+                    list.appendChild(li);
+                });
+            });
+        }, 150);
+    });
+})();
+"""
+
+
 #******************************************************************************
 #
 #******************************************************************************
@@ -223,74 +343,762 @@ def eprint(*args, **kwargs):
 #******************************************************************************
 #
 #******************************************************************************
-def copy_if_newer(src, dst):
-    # print(f'would be copying {src} -> {dst}')
-    # return
-    if not dst.exists() or (src.stat().st_mtime - dst.stat().st_mtime > 0):
-        shutil.copy2(src, dst)
+class Trace:
+    """Wall time and call counts per stage, written as json lines.
+
+    Each page record holds the stages that ran since the previous record,
+    so the first record of a run includes startup. Stages nest: md.convert
+    includes the markdown processors and pygments inside it.
+    """
+
+    def __init__(self, log_file: Path, profile_dir: Optional[Path] = None):
+        self.log_file = log_file
+        self.profile_dir = profile_dir
+        self.current: Dict[str, List] = {}
+        self.totals: Dict[str, List] = {}
+        self.pages: List[Tuple[float, str]] = []
+        self.last_record: Optional[Dict] = None
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        entry = self.current.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def wrap(self, name: str, func):
+        def traced(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return traced
+
+    @contextlib.contextmanager
+    def page(self, name: str):
+        profile = None
+        if self.profile_dir:
+            import cProfile
+            profile = cProfile.Profile()
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(str(self.profile_dir / (name.strip(os.sep).replace(os.sep, '_') + '.prof')))
+            self.page_done(name, time.perf_counter() - start)
+
+    def page_done(self, name: str, seconds: float):
+        record = {
+            'page': name,
+            'seconds': round(seconds, 6),
+            'stages': {stage: {'seconds': round(t, 6), 'calls': c} for stage, (t, c) in self.current.items()},
+        }
+        self.current = {}
+        self.write(record)
+        self.merge(record)
+        self.last_record = record
+
+    def merge(self, record: Dict):
+        """Add a page record to the totals, also used for records from worker processes."""
+        self.pages.append((record['seconds'], record['page']))
+        for stage, entry in record['stages'].items():
+            total = self.totals.setdefault(stage, [0.0, 0])
+            total[0] += entry['seconds']
+            total[1] += entry['calls']
+
+    def write(self, record: Dict):
+        with open(self.log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def summary(self, top: int = 10) -> Dict:
+        stages = sorted(self.totals.items(), key=lambda item: item[1][0], reverse=True)
+        return {
+            'pages': len(self.pages),
+            'stages': [{'stage': stage, 'seconds': round(t, 6), 'calls': c} for stage, (t, c) in stages],
+            'slowest_pages': [{'page': page, 'seconds': t} for t, page in sorted(self.pages, reverse=True)[:top]],
+        }
+
+
+trace: Optional[Trace] = None
+
+
+def enable_trace(options: Dict) -> Optional[Trace]:
+    """Turn on the trace when the trace option or VIMWIKI_MARKDOWN_TRACE names a log file."""
+    global trace
+    log_file = os.environ.get('VIMWIKI_MARKDOWN_TRACE') or options.get('trace')
+    if not log_file:
+        # a resident server must not keep tracing for requests that did not ask for it
+        trace = None
+        return None
+    if trace is None or trace.log_file != Path(log_file):
+        profile_dir = os.environ.get('VIMWIKI_MARKDOWN_PROFILE') or options.get('trace_profile')
+        trace = Trace(Path(log_file), Path(profile_dir) if profile_dir else None)
+    return trace
+
+
+def traced_stage(name: str):
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.stage(name)
+
+
+def traced_page(name: str):
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.page(name)
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def write_to_file(output_file: Path, content: str):
-    with open(output_file, 'w') as o:
-        o.write(content)
+fsync_policies = ('never', 'file', 'full')
+fsync_policy = 'never'
+
+
+def set_fsync_policy(options: Dict):
+    """never: leave it to the os, file: fsync every output, full: also fsync its directory."""
+    global fsync_policy
+    policy = options.get('fsync', 'never')
+    if policy not in fsync_policies:
+        raise ValueError(f'unknown fsync policy {policy!r}, expected one of {", ".join(fsync_policies)}')
+    fsync_policy = policy
+
+
+def fsync_directory(path: Path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can not be opened on windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_file_path(output_file: Path) -> Path:
+    return output_file.with_name(f'.{output_file.name}.{os.getpid()}.tmp')
+
+
+def sync_file(f):
+    if fsync_policy != 'never':
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_to_file(output_file: Path, content: str) -> bool:
+    """Write content through a temporary file renamed over output_file.
+
+    Readers see either the old or the new file, never a partial one.
+    When the file already holds the same bytes it is left alone, keeping
+    its mtime, and False is returned.
+    """
+    if os.linesep != '\n':
+        content = content.replace('\n', os.linesep)
+    data = content.encode(locale.getpreferredencoding(False))
+
+    try:
+        if os.path.getsize(output_file) == len(data):
+            with open(output_file, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+
+    tmp = temp_file_path(output_file)
+    try:
+        with open(tmp, 'wb') as o:
+            o.write(data)
+            sync_file(o)
+        os.replace(tmp, output_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    if fsync_policy == 'full':
+        fsync_directory(output_file.parent)
+    return True
+
+
+def same_file_contents(a: Path, b: Path) -> bool:
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            while True:
+                block = fa.read(1 << 20)
+                if block != fb.read(1 << 20):
+                    return False
+                if not block:
+                    return True
+    except OSError:
+        return False
+
+
+def write_chunks_to_file(output_file: Path, chunks: Iterable[str]) -> bool:
+    """Like write_to_file for content produced in parts, only one part is held at a time.
+
+    The temporary file is compared with output_file once complete instead.
+    """
+    tmp = temp_file_path(output_file)
+    try:
+        with open(tmp, 'w', encoding=locale.getpreferredencoding(False)) as o:
+            for chunk in chunks:
+                o.write(chunk)
+            sync_file(o)
+        if same_file_contents(tmp, output_file):
+            os.unlink(tmp)
+            return False
+        os.replace(tmp, output_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    if fsync_policy == 'full':
+        fsync_directory(output_file.parent)
+    return True
 
 
 #******************************************************************************
 #
 #******************************************************************************
-class LinkInlineProc(markdown.inlinepatterns.LinkInlineProcessor):
-    """Fix wiki links"""
+class BatchIO:
+    """Overlaps the file system round trips of a batch build with converting pages.
+
+    On a network filesystem every open, stat and mkdir waits for the
+    server. While a build runs, page sources are read and hashed on
+    threads a few pages ahead of the page being converted, html is
+    written on a thread behind it through a bounded queue, and the stats
+    of templates and output directories are made once.
+    """
+
+    # bigger sources are left to large page conversion, see scan_large_wiki_page
+    max_source_size = 1024 * 1024
+
+    def __init__(self, threads: int, read_ahead: int = 16, write_behind: int = 16):
+        import threading
+
+        self.threads = threads
+        self.read_ahead = read_ahead
+        # the threads start on first use, batch worker processes are forked without them
+        self.readers = None
+        self.writer = None
+        self.write_slots = threading.BoundedSemaphore(write_behind)
+        self.write_errors: List[BaseException] = []
+        self.sources: Dict[str, concurrent.futures.Future] = {}
+        self.stats: Dict[str, Optional[os.stat_result]] = {}
+        self.dirs: Set[str] = set()
+
+    def __enter__(self):
+        global batch_io
+        batch_io = self
+        return self
+
+    def __exit__(self, *exc):
+        global batch_io
+        batch_io = None
+        self.close()
+
+    @classmethod
+    def read_source(cls, path: Path) -> Optional[Tuple[bytes, str]]:
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > cls.max_source_size:
+                    return None
+                data = f.read()
+        except OSError:
+            return None
+        return data, hashlib.sha256(data).hexdigest()
+
+    def pages(self, jobs: List[BatchJob]) -> Iterator[BatchJob]:
+        """Yield jobs in order, with the sources of the next ones being read."""
+        if self.readers is None:
+            import concurrent.futures
+            self.readers = concurrent.futures.ThreadPoolExecutor(self.threads)
+        for i, job in enumerate(jobs):
+            for ahead in jobs[i:i + self.read_ahead]:
+                key = os.path.abspath(ahead[0])
+                if key not in self.sources:
+                    self.sources[key] = self.readers.submit(self.read_source, ahead[0])
+            yield job
+            self.sources.pop(os.path.abspath(job[0]), None)
+
+    def source(self, path: Path) -> Optional[Tuple[bytes, str]]:
+        future = self.sources.get(os.path.abspath(path))
+        return future.result() if future is not None else None
+
+    def stat(self, path: Path) -> Optional[os.stat_result]:
+        key = os.path.abspath(path)
+        if key not in self.stats:
+            try:
+                self.stats[key] = os.stat(key)
+            except OSError:
+                self.stats[key] = None
+        return self.stats[key]
+
+    def write(self, output_file: Path, content: str):
+        self.write_slots.acquire()
+        if self.write_errors:
+            self.write_slots.release()
+            raise self.write_errors[0]
+        if self.writer is None:
+            import concurrent.futures
+            # a single writer keeps the writes of a page in order
+            self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.writer.submit(self._write, output_file, content)
+
+    def _write(self, output_file: Path, content: str):
+        try:
+            write_to_file(output_file, content)
+        except BaseException as e:
+            self.write_errors.append(e)
+        finally:
+            self.write_slots.release()
+
+    def close(self):
+        """Wait for the queued writes, raising the first one that failed.
+
+        The threads are stopped and start again on next use.
+        """
+        for future in self.sources.values():
+            future.cancel()
+        for executor in (self.readers, self.writer):
+            if executor is not None:
+                executor.shutdown()
+        self.readers = self.writer = None
+        self.sources = {}
+        if self.write_errors:
+            raise self.write_errors[0]
+
+
+batch_io: Optional[BatchIO] = None
+
+
+def open_batch_io(options: Dict):
+    """A BatchIO with io_threads reader threads, none when the option is 0."""
+    threads = options.get('io_threads', 2)
+    if not threads:
+        return contextlib.nullcontext()
+    return BatchIO(threads)
+
+
+def prefetched_source(path: Path) -> Optional[Tuple[bytes, str]]:
+    """The bytes and hash of a page source read ahead by the running batch build."""
+    return batch_io.source(path) if batch_io is not None else None
+
+
+def read_ahead(jobs: List[BatchJob]) -> Iterator[BatchJob]:
+    return batch_io.pages(jobs) if batch_io is not None else iter(jobs)
+
+
+def cached_stat(path: Path) -> Optional[os.stat_result]:
+    """os.stat of a template or directory, made once while a batch build runs."""
+    if batch_io is not None:
+        return batch_io.stat(path)
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def is_file(path: Path) -> bool:
+    st = cached_stat(path)
+    return st is not None and stat.S_ISREG(st.st_mode)
+
+
+def ensure_dir(path: Path):
+    """mkdir -p, each directory once while a batch build runs."""
+    if batch_io is None:
+        path.mkdir(parents=True, exist_ok=True)
+        return
+    key = os.path.abspath(path)
+    if key not in batch_io.dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        batch_io.dirs.add(key)
+
+
+def write_output(output_file: Path, content: str):
+    """write_to_file, queued behind the conversion while a batch build runs."""
+    if batch_io is not None:
+        batch_io.write(output_file, content)
+    else:
+        write_to_file(output_file, content)
 
-    def __init__(self, *args, auto_index, **kwargs):
-        super(LinkInlineProc, self).__init__(*args, **kwargs)
-        self.auto_index = auto_index
 
-    def getLink(self, *args, **kwargs):
-        href, title, index, handled = super().getLink(*args, **kwargs)
-        if not href.startswith('http') and not href.endswith('.html'):
-            if self.auto_index and href.endswith('/'):
-                href += 'index.html'
-            elif not href.endswith('/'):
-                href += '.html'
-        return href, title, index, handled
+#******************************************************************************
+#
+#******************************************************************************
+# markdown and pygments are most of the startup time of a single page
+# conversion. They are imported on first use, the classes extending them are
+# defined at the same time.
+markdown = None
+LinkInlineProc = None
+ImageInlineProc = None
+HeadingTreeProc = None
+CachedCodeHilite = None
+
+
+def import_markdown():
+    """Import markdown and define the processors for wiki links, images and headings."""
+    global markdown, LinkInlineProc, ImageInlineProc, HeadingTreeProc
+    if markdown is not None:
+        return markdown
+
+    with traced_stage('import markdown'):
+        import markdown
+
+    class LinkInlineProc(markdown.inlinepatterns.LinkInlineProcessor):
+        """Fix wiki links"""
+
+        def __init__(self, *args, auto_index, **kwargs):
+            super(LinkInlineProc, self).__init__(*args, **kwargs)
+            self.auto_index = auto_index
+            self.links: List[str] = []
+
+        def getLink(self, *args, **kwargs):
+            href, title, index, handled = super().getLink(*args, **kwargs)
+            if not href.startswith('http') and not href.endswith('.html'):
+                if self.auto_index and href.endswith('/'):
+                    href += 'index.html'
+                elif not href.endswith('/'):
+                    href += '.html'
+            if handled and not href.startswith(('http', '#', 'mailto:')):
+                self.links.append(href)
+            return href, title, index, handled
+
+    class ImageInlineProc(markdown.inlinepatterns.ImageInlineProcessor):
+        """Fix wiki image links, the images are copied by the AssetStore"""
+
+        def __init__(self, *args, src_file_dir: Path, output_dir: Path, **kwargs):
+            super(ImageInlineProc, self).__init__(*args, **kwargs)
+            self.src_file_dir = src_file_dir
+            self.output_dir = output_dir
+            self.copied: List[Tuple[Path, Path]] = []
+            self.hrefs: List[str] = []
+
+        def getLink(self, *args, **kwargs):
+            href, title, index, handled = super().getLink(*args, **kwargs)
+            self.copied.append((self.src_file_dir / href, self.output_dir / href))
+            self.hrefs.append(href)
+            return href, title, index, handled
+
+    class HeadingTreeProc(markdown.treeprocessors.Treeprocessor):
+        """Record the headings of a page, giving those without an id one to link to"""
+
+        tags = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+        placeholder_re = re.compile('\x02[^\x03]*\x03')
+
+        def __init__(self, *args, **kwargs):
+            super(HeadingTreeProc, self).__init__(*args, **kwargs)
+            self.headings: List[Tuple[int, str, str]] = []
+            self.anchors: Set[str] = set()
+
+        def anchor(self, text: str) -> str:
+            slug = re.sub(r'[-\s]+', '-', re.sub(r'[^\w\s-]', '', text.lower()).strip()) or 'section'
+            anchor = slug
+            n = 0
+            while anchor in self.anchors:
+                n += 1
+                anchor = f'{slug}_{n}'
+            return anchor
+
+        def run(self, root):
+            for el in root.iter():
+                if el.tag not in self.tags:
+                    continue
+                # raw html in a heading is still stashed at this point
+                text = self.placeholder_re.sub('', ''.join(el.itertext())).strip()
+                anchor = el.get('id') or self.anchor(text)
+                el.set('id', anchor)
+                self.anchors.add(anchor)
+                self.headings.append((int(el.tag[1]), text, anchor))
+
+    return markdown
 
 
 #******************************************************************************
 #
 #******************************************************************************
-class ImageInlineProc(markdown.inlinepatterns.ImageInlineProcessor):
-    """Fix wiki image links"""
+def open_sqlite(path: Path):
+    """A connection to the database at path, autocommitting, in WAL mode so readers do not block writers."""
+    import sqlite3
 
-    def __init__(self, *args, src_file_dir: Path, output_dir: Path, **kwargs):
-        super(ImageInlineProc, self).__init__(*args, **kwargs)
-        self.src_file_dir = src_file_dir
-        self.output_dir = output_dir
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
 
-    def getLink(self, *args, **kwargs):
-        href, title, index, handled = super().getLink(*args, **kwargs)
 
-        src = self.src_file_dir / href
-        dst = self.output_dir / href
+#******************************************************************************
+#
+#******************************************************************************
+class HighlightCache:
+    """Disk backed LRU cache of highlighted code blocks.
+
+    Entries are keyed by a hash of the code, language, codehilite options
+    and library versions, and evicted least recently used first once the
+    stored html grows past max_bytes.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.db = open_sqlite(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks '
+                        '(key TEXT PRIMARY KEY, html TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.db.execute('SELECT html FROM blocks WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute('UPDATE blocks SET used = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, html: str):
+        size = len(html)
+        self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)', (key, html, size, time.time()))
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # other processes may have filled the cache too, recount before trimming
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+        target = self.max_bytes * 0.9
+        if self.size <= target:
+            return
+        rows = self.db.execute('SELECT key, size FROM blocks ORDER BY used').fetchall()
+        stale = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            stale.append((key,))
+            self.size -= size
+        self.db.executemany('DELETE FROM blocks WHERE key = ?', stale)
 
-        Path(dst.parent).mkdir(parents=True, exist_ok=True)
-        copy_if_newer(src, dst)
 
-        return href, title, index, handled
+#******************************************************************************
+#
+#******************************************************************************
+def import_codehilite():
+    """Import codehilite, and with it pygments, and route it through the highlight cache."""
+    global CachedCodeHilite
+    if CachedCodeHilite is not None:
+        return CachedCodeHilite
+
+    import_markdown()
+    with traced_stage('import pygments'):
+        from markdown.extensions import codehilite, fenced_code
+
+    class CachedCodeHilite(codehilite.CodeHilite):
+        """CodeHilite that looks up its output in the active HighlightCache first."""
+
+        cache: Optional[HighlightCache] = None
+
+        def cache_key(self, shebang: bool) -> str:
+            import pygments
+            key = json.dumps([
+                self.src,
+                self.lang,
+                self.guess_lang,
+                self.lang_prefix,
+                self.pygments_formatter,
+                self.options,
+                shebang,
+                pygments.__version__,
+                markdown.__version__,
+            ], sort_keys=True, default=str)
+            return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+        def hilite(self, shebang: bool = True) -> str:
+            cache = CachedCodeHilite.cache
+            if cache is None or not self.use_pygments or callable(self.pygments_formatter):
+                with traced_stage('pygments'):
+                    return super().hilite(shebang)
+
+            key = self.cache_key(shebang)
+            html = cache.get(key)
+            if html is None:
+                with traced_stage('pygments'):
+                    html = super().hilite(shebang)
+                cache.put(key, html)
+            return html
+
+    codehilite.CodeHilite = CachedCodeHilite
+    fenced_code.CodeHilite = CachedCodeHilite
+    return CachedCodeHilite
+
+
+highlight_caches: Dict[str, HighlightCache] = {}
+
+
+def cache_location(option, file_name: str) -> Optional[Path]:
+    """The file a cache option names, true for file_name in the user's cache directory and false for none."""
+    if option is False:
+        return None
+    if option is True:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(cache_home) / 'vimwiki_markdown' / file_name
+    return Path(option)
+
+
+def install_highlight_cache(options: Dict) -> Optional[HighlightCache]:
+    """Route codehilite through the highlight cache configured in options."""
+    import_codehilite()
+
+    location = cache_location(options.get('highlight_cache', True), 'highlight.sqlite')
+    if location is None:
+        CachedCodeHilite.cache = None
+        return None
+
+    key = os.path.abspath(location)
+    if key not in highlight_caches:
+        max_bytes = int(options.get('highlight_cache_size', 64) * 1024 * 1024)
+        highlight_caches[key] = HighlightCache(location, max_bytes)
+
+    CachedCodeHilite.cache = highlight_caches[key]
+    return CachedCodeHilite.cache
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def setup_markdown_converter(options, src_file_dir: Path, dst_dir: Path) -> markdown.Markdown:
-    extensions = ['fenced_code', 'tables','codehilite']
-    if 'markdown_extensions' in options:
-        extensions += options['markdown_extensions'].split(',')
-    extensions = set([e for e in extensions if e])
+class FragmentCache(HighlightCache):
+    """Disk backed LRU cache of converted page bodies.
+
+    Entries are keyed by a hash of the body, the converter options that
+    shape its html and library versions, and hold the links, images and
+    headings the converter recorded along with the html.
+    """
+
+    def get_fragment(self, key: str) -> Optional[Dict]:
+        fragment = self.get(key)
+        return json.loads(fragment) if fragment is not None else None
+
+    def put_fragment(self, key: str, content: str, links: List[str], images: List[str],
+                     headings: Optional[List[Tuple[int, str, str]]]):
+        self.put(key, json.dumps({'content': content, 'links': links, 'images': images, 'headings': headings}))
+
+
+fragment_caches: Dict[str, FragmentCache] = {}
+
 
-    md = markdown.Markdown(extensions=extensions)
+def open_fragment_cache(options: Dict) -> Optional[FragmentCache]:
+    location = cache_location(options.get('fragment_cache', True), 'fragments.sqlite')
+    if location is None:
+        return None
+
+    key = os.path.abspath(location)
+    if key not in fragment_caches:
+        max_bytes = int(options.get('fragment_cache_size', 256) * 1024 * 1024)
+        fragment_caches[key] = FragmentCache(location, max_bytes)
+    return fragment_caches[key]
+
+
+def fragment_cache_counts() -> Tuple[int, int]:
+    return (sum(cache.hits for cache in fragment_caches.values()),
+            sum(cache.misses for cache in fragment_caches.values()))
+
+
+def convert_body(md: markdown.Markdown, page: WikiPage) -> str:
+    """md.convert of the page body, looked up in the converter's fragment cache first.
+
+    On a hit the links, images and headings of the page are handed to the
+    converter's processors as if it had converted the body. The key of
+    the html in the cache is left in page.fragment.
+    """
+    if md.fragment_cache is None:
+        with traced_stage('md.convert'):
+            return md.convert(page.body)
+
+    with traced_stage('fragment_cache'):
+        key = hashlib.sha256(json.dumps([page.body, md.fragment_options]).encode('utf-8')).hexdigest()
+        page.fragment = key
+        fragment = md.fragment_cache.get_fragment(key)
+    if fragment is not None:
+        if 'link' in md.inlinePatterns and isinstance(md.inlinePatterns['link'], LinkInlineProc):
+            md.inlinePatterns['link'].links = fragment['links']
+        if 'image' in md.inlinePatterns and isinstance(md.inlinePatterns['image'], ImageInlineProc):
+            image_proc = md.inlinePatterns['image']
+            image_proc.hrefs = fragment['images']
+            image_proc.copied = [(image_proc.src_file_dir / href, image_proc.output_dir / href)
+                                 for href in fragment['images']]
+        if fragment['headings'] is not None and recorded_headings(md) is not None:
+            md.treeprocessors['headings'].headings = [tuple(h) for h in fragment['headings']]
+        return fragment['content']
+
+    with traced_stage('md.convert'):
+        content = md.convert(page.body)
+    with traced_stage('fragment_cache'):
+        md.fragment_cache.put_fragment(key, content, recorded_links(md), image_hrefs(md), recorded_headings(md))
+    return content
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def setup_markdown_converter(options,
+                             src_file_dir: Path,
+                             dst_dir: Path,
+                             highlight: bool = True) -> markdown.Markdown:
+    with traced_stage('setup_markdown_converter'):
+        md = create_markdown_converter(options, src_file_dir, dst_dir, highlight)
+    if trace is not None:
+        trace_markdown_converter(md)
+    return md
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def trace_markdown_converter(md: markdown.Markdown):
+    """Time every markdown processor of the converter as its own stage."""
+    registries = [md.preprocessors, md.parser.blockprocessors, md.treeprocessors, md.postprocessors]
+    for registry in registries:
+        for processor in registry:
+            name = f'markdown.{type(processor).__name__}'
+            processor.run = trace.wrap(name, processor.run)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def create_markdown_converter(options,
+                              src_file_dir: Path,
+                              dst_dir: Path,
+                              highlight: bool = True) -> markdown.Markdown:
+    """Build a converter, without highlight it leaves out fenced_code and codehilite.
+
+    Both import pygments, pages without code blocks convert the same without them.
+    """
+    import_markdown()
+
+    extensions = converter_extensions(options, highlight)
+    if 'codehilite' in extensions:
+        install_highlight_cache(options)
+
+    md = markdown.Markdown(extensions=[load_markdown_extension(e) for e in extensions])
+    # other extensions may tie blocks together, see convert_chunks
+    md.large_page_size = 0
+    if extensions <= chunkable_extensions:
+        md.large_page_size = int(options.get('large_page_size', 1024 * 1024))
     md.inlinePatterns.register(
         LinkInlineProc(
             markdown.inlinepatterns.LINK_RE,
@@ -307,34 +1115,302 @@ def setup_markdown_converter(options, src_file_dir: Path, dst_dir: Path) -> mark
                 output_dir=dst_dir
             ), 'image', 160
         )
+    if options.get('heading_index', False):
+        # after unescape, heading text is final
+        md.treeprocessors.register(HeadingTreeProc(md), 'headings', -10)
+
+    md.fragment_cache = open_fragment_cache(options)
+    if md.fragment_cache is not None:
+        # everything besides the body that goes into the html
+        md.fragment_options = [
+            sorted(extensions),
+            bool(options.get('auto_index', False)),
+            bool(options.get('copy_images', True)),
+            bool(options.get('heading_index', False)),
+            markdown.__version__,
+            sys.modules['pygments'].__version__ if 'codehilite' in extensions else None,
+        ]
     return md
 
 
+def converter_extensions(options: Dict, highlight: bool = True) -> Set[str]:
+    extensions = ['tables']
+    if highlight:
+        extensions += ['fenced_code', 'codehilite']
+    if 'markdown_extensions' in options:
+        extensions += [e.strip() for e in options['markdown_extensions'].split(',')]
+    return set([e for e in extensions if e])
+
+
+def load_markdown_extension(name: str):
+    """The extension bundled with markdown for a short name, any other name as is.
+
+    markdown resolves names through the installed entry points, which
+    takes longer than building the extension.
+    """
+    if not name.isidentifier():
+        return name
+    try:
+        module = importlib.import_module('markdown.extensions.' + name)
+    except ImportError:
+        return name
+    return module.makeExtension()
+
+
 #******************************************************************************
 #
 #******************************************************************************
-def try_read_html_template(tpl_dir: Path,
-                           tpl_default_name: str,
-                           tpl_ext: str,
-                           tpl_requested_name: Optional[str]) -> Optional[str]:
-    template = None
+def rebind_markdown_converter(md: markdown.Markdown, src_file_dir: Path, dst_dir: Path):
+    """Point a reused converter at the next page, image paths are relative to it."""
+    md.reset()
+    if 'image' in md.inlinePatterns:
+        image_proc = md.inlinePatterns['image']
+        if isinstance(image_proc, ImageInlineProc):
+            image_proc.src_file_dir = src_file_dir
+            image_proc.output_dir = dst_dir
+            image_proc.copied = []
+            image_proc.hrefs = []
+    if 'link' in md.inlinePatterns:
+        link_proc = md.inlinePatterns['link']
+        if isinstance(link_proc, LinkInlineProc):
+            link_proc.links = []
+    if 'headings' in md.treeprocessors:
+        heading_proc = md.treeprocessors['headings']
+        if isinstance(heading_proc, HeadingTreeProc):
+            heading_proc.headings = []
+            heading_proc.anchors = set()
+
 
+#******************************************************************************
+#
+#******************************************************************************
+class ConverterPool:
+    """Configured converters kept for reuse, the least recently used is dropped first.
+
+    Converters are keyed by the options that shape them and the source and
+    output roots of their wiki, so options differing only in css_files or
+    the search index share one. Reusing a converter only rebinds it to the
+    page being converted.
+    """
+
+    def __init__(self, max_size: int = 8):
+        self.max_size = max_size
+        # in order of use, dicts keep insertion order
+        self.converters: Dict[str, markdown.Markdown] = {}
+        self.created = 0
+
+    @staticmethod
+    def options_key(options: Dict, highlight: bool = True) -> Dict:
+        return {
+            'extensions': sorted(converter_extensions(options, highlight)),
+            'auto_index': bool(options.get('auto_index', False)),
+            'copy_images': bool(options.get('copy_images', True)),
+            'highlight_cache': options.get('highlight_cache', True),
+            'highlight_cache_size': options.get('highlight_cache_size', 64),
+            'fragment_cache': options.get('fragment_cache', True),
+            'fragment_cache_size': options.get('fragment_cache_size', 256),
+            'large_page_size': options.get('large_page_size', 1024 * 1024),
+            'heading_index': bool(options.get('heading_index', False)),
+            # traced converters report to the trace they were built with
+            'trace': str(trace.log_file) if trace is not None else None,
+        }
+
+    def get(self,
+            options: Dict,
+            src_root: Path,
+            dst_root: Path,
+            src_file_dir: Optional[Path] = None,
+            dst_dir: Optional[Path] = None,
+            highlight: bool = True) -> markdown.Markdown:
+        """A converter for options, bound to src_file_dir and dst_dir (by default the roots)."""
+        src_file_dir = src_root if src_file_dir is None else src_file_dir
+        dst_dir = dst_root if dst_dir is None else dst_dir
+        key = json.dumps([self.options_key(options, highlight),
+                          os.path.abspath(src_root),
+                          os.path.abspath(dst_root)], sort_keys=True)
+
+        md = self.converters.pop(key, None)
+        if md is None:
+            md = setup_markdown_converter(options, src_file_dir, dst_dir, highlight)
+            self.created += 1
+        else:
+            rebind_markdown_converter(md, src_file_dir, dst_dir)
+            if 'hilite' in md.treeprocessors:
+                # the cache is shared by all converters, point it back at this one's
+                install_highlight_cache(options)
+        self.converters[key] = md
+
+        while len(self.converters) > self.max_size:
+            del self.converters[next(iter(self.converters))]
+        return md
+
+
+converter_pool = ConverterPool()
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def recorded_links(md: markdown.Markdown) -> List[str]:
+    if 'link' in md.inlinePatterns:
+        link_proc = md.inlinePatterns['link']
+        if isinstance(link_proc, LinkInlineProc):
+            return link_proc.links
+    return []
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def copied_images(md: markdown.Markdown) -> List[Tuple[Path, Path]]:
+    if 'image' in md.inlinePatterns:
+        image_proc = md.inlinePatterns['image']
+        if isinstance(image_proc, ImageInlineProc):
+            return image_proc.copied
+    return []
+
+
+def image_hrefs(md: markdown.Markdown) -> List[str]:
+    """The image links of the page as written, copied_images resolves them."""
+    if 'image' in md.inlinePatterns:
+        image_proc = md.inlinePatterns['image']
+        if isinstance(image_proc, ImageInlineProc):
+            return image_proc.hrefs
+    return []
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def recorded_headings(md: markdown.Markdown) -> Optional[List[Tuple[int, str, str]]]:
+    """(level, text, anchor) of every heading, None when the converter does not record them."""
+    if 'headings' in md.treeprocessors:
+        heading_proc = md.treeprocessors['headings']
+        if isinstance(heading_proc, HeadingTreeProc):
+            return heading_proc.headings
+    return None
+
+
+def toc_html(headings: Iterable[Tuple[int, str, str]], href: str = '') -> str:
+    """Nested lists linking to headings, in page order."""
+    parts = []
+    levels: List[int] = []
+    for level, text, anchor in headings:
+        while levels and level < levels[-1]:
+            parts.append('</li></ul>')
+            levels.pop()
+        if levels and level == levels[-1]:
+            parts.append('</li>')
+        else:
+            parts.append('<ul>')
+            levels.append(level)
+        parts.append(f'<li><a href="{escape_html(href + "#" + anchor)}">{escape_html(text)}</a>')
+    parts.append('</li></ul>' * len(levels))
+    return ''.join(parts)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def resolve_html_template(tpl_dir: Path,
+                          tpl_default_name: str,
+                          tpl_ext: str,
+                          tpl_requested_name: Optional[str],
+                          verbose: bool = True) -> Optional[Path]:
     tpl_file = tpl_dir / Path(tpl_default_name + tpl_ext)
 
     if tpl_requested_name:
         req_tpl_file = tpl_dir / Path(tpl_requested_name + tpl_ext)
-        if req_tpl_file.is_file():
+        if is_file(req_tpl_file):
             tpl_file = req_tpl_file
-        else:
+        elif verbose:
             eprint(f'markdown requested template {req_tpl_file} is not a file!')
             eprint(f'falling back to wimwiki default: {tpl_file}.')
 
-    if tpl_file.is_file():
-        with open(tpl_file, 'r') as f:
-            template = f.read()
-    else:
+    if is_file(tpl_file):
+        return tpl_file
+
+    if verbose:
         eprint(f'{tpl_file} is not a file!')
         eprint(f'falling back to internal default.')
+    return None
+
+
+#******************************************************************************
+#
+#******************************************************************************
+template_placeholders = ('%root_path%', '%title%', '%date%', '%content%', '%backlinks%', '%toc%')
+
+
+class HtmlTemplate:
+    """A template split once into literal text and placeholders.
+
+    Rendering fills every placeholder in a single pass, so placeholder
+    values are never scanned again and a %title% inside the page content
+    is left alone.
+    """
+
+    placeholder_re = re.compile('|'.join(re.escape(p) for p in template_placeholders))
+
+    def __init__(self, text: str):
+        self.text = text
+        # literal text at even indices, placeholder names at odd indices
+        self.segments = self._split(text)
+        self.placeholders = set(self.segments[1::2])
+
+    def _split(self, text: str) -> List[str]:
+        segments = []
+        pos = 0
+        for m in self.placeholder_re.finditer(text):
+            segments.append(text[pos:m.start()])
+            segments.append(m.group())
+            pos = m.end()
+        segments.append(text[pos:])
+        return segments
+
+    def render(self, placeholders: Dict[str, str]) -> str:
+        parts = self.segments[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = placeholders.get(parts[i], parts[i])
+        return ''.join(parts)
+
+    def stream(self, placeholders: Dict[str, Iterable[str]]) -> Iterator[str]:
+        """Like render, placeholder values may be iterables of strings, yielded in turn."""
+        for i, segment in enumerate(self.segments):
+            value = placeholders.get(segment, segment) if i % 2 else segment
+            if isinstance(value, str):
+                yield value
+            else:
+                yield from value
+
+
+html_templates: Dict[str, Tuple[int, HtmlTemplate]] = {}
+
+
+def read_html_template(tpl_file: Path) -> HtmlTemplate:
+    """Read and compile a template, cached for as long as its mtime stays the same."""
+    key = os.path.abspath(tpl_file)
+    mtime = cached_stat(tpl_file).st_mtime_ns
+    cached = html_templates.get(key)
+    if cached is None or cached[0] != mtime:
+        with open(tpl_file, 'r') as f:
+            cached = (mtime, HtmlTemplate(f.read()))
+        html_templates[key] = cached
+    return cached[1]
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def try_read_html_template(tpl_dir: Path,
+                           tpl_default_name: str,
+                           tpl_ext: str,
+                           tpl_requested_name: Optional[str]) -> Optional[HtmlTemplate]:
+    template = None
+
+    tpl_file = resolve_html_template(tpl_dir, tpl_default_name, tpl_ext, tpl_requested_name)
+    if tpl_file:
+        template = read_html_template(tpl_file)
 
     return template
 
@@ -342,79 +1418,1992 @@ def try_read_html_template(tpl_dir: Path,
 #******************************************************************************
 #
 #******************************************************************************
-def apply_defaults(root_path: Path) -> str:
-    # lets write out the default stylesheet as well
-    dst = root_path / 'css/default_style.css'
-    Path(dst.parent).mkdir(parents=True, exist_ok=True)
-    write_to_file(dst, default_css)
+# output roots given the default stylesheet by the running batch, request or watch cycle
+applied_defaults: Set[str] = set()
+compiled_default_template = HtmlTemplate(default_template)
 
-    return default_template
+
+def apply_defaults(root_path: Path) -> HtmlTemplate:
+    # lets write out the default stylesheet as well, once per output root
+    key = os.path.normpath(os.path.abspath(root_path))
+    if key not in applied_defaults:
+        dst = root_path / 'css/default_style.css'
+        Path(dst.parent).mkdir(parents=True, exist_ok=True)
+        write_to_file(dst, default_css)
+        applied_defaults.add(key)
+
+    return compiled_default_template
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def process_input_file(md: markdown.Markdown,
-                       input_file: Path,
-                       rel_root_path: str) -> Tuple[Dict[str, str], str]:
-    placeholders = {
-        '%root_path%': rel_root_path,
-        '%title%':     input_file.stem,
-        '%date%':      datetime.datetime.today().strftime( '%Y-%m-%d')
-    }
+class WikiPage:
+    """The header directives and markdown body of a wiki page.
+
+    Once converted, fragment is the key of its html in the fragment cache
+    (unless it was streamed, see convert_chunks) and headings what the
+    converter recorded. Pages read back from the cache carry the html as
+    content instead of a body.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.title = path.stem
+        self.date: Optional[str] = None
+        self.template: Optional[str] = None
+        self.nohtml = False
+        self.body = ''
+        self.fragment: Optional[str] = None
+        self.content: Optional[str] = None
+        self.headings: Optional[List[Tuple[int, str, str]]] = None
+
+
+def read_directive(page: WikiPage, line: str) -> bool:
+    """Apply a %title, %date or %template line to page, returns whether it was one."""
+    if line.startswith('%title'):
+        page.title = line[7:-1]
+    elif line.startswith('%date'):
+        page.date = line[6:-1]
+    elif line.startswith('%template'):
+        page.template = line[10:-1]
+    else:
+        return False
+    return True
 
-    template = None
+
+def read_wiki_page(input_file: Path) -> WikiPage:
+    """Read a page, pulling out the vimwiki %title, %date, %template and %nohtml lines.
+
+    A %nohtml page is returned with nohtml set and its body left empty.
+    """
+    page = WikiPage(input_file)
+    body = []
+    source = prefetched_source(input_file)
+    with io.TextIOWrapper(io.BytesIO(source[0])) if source is not None else open(input_file, 'r') as f:
+        for line in f:
+            if line.startswith('%nohtml'):
+                page.nohtml = True
+                return page
+            elif not read_directive(page, line):
+                body.append(line)
+
+    page.body = ''.join(body)
+    return page
+
+
+code_block_re = re.compile(r'(?: *(?:```|~~~)|    )')
+quote_marker_re = re.compile(r'(?: {0,3}> ?)*')
+
+
+def page_has_code(input_file: Path) -> bool:
+    """Whether the page may hold a fenced or indented code block."""
+    with open(input_file, 'r') as f:
+        for line in f:
+            # code blocks can be nested in block quotes and indented with tabs
+            line = line[quote_marker_re.match(line).end():].expandtabs(4)
+            if code_block_re.match(line):
+                return True
+    return False
+
+
+#******************************************************************************
+#
+#******************************************************************************
+# Pages larger than a converter's large_page_size are converted a few blocks
+# at a time and streamed into the output file. That is only done with
+# extensions that keep to a single block, and for pages without reference
+# style links or raw html, which markdown resolves across the whole document.
+chunkable_extensions = {'tables', 'fenced_code', 'codehilite', 'nl2br', 'sane_lists'}
+unchunkable_line_re = re.compile(r' {0,3}(?:\[[^\]]*\]:|<[a-zA-Z!/?])')
+fence_re = re.compile(r'`{3,}|~{3,}')
+# openers with attributes or hl_lines are left to whole page conversion
+simple_fence_re = re.compile(r'(?:`{3,}|~{3,}) *\.?[\w#.+-]* *$')
+chunk_size = 64 * 1024
+chunk_end = 'vimwikimarkdownchunkend'
+
+
+def is_large_page(md: markdown.Markdown, input_file: Path) -> bool:
+    size = getattr(md, 'large_page_size', 0)
+    if size <= 0:
+        return False
+    source = prefetched_source(input_file)
+    return (len(source[0]) if source is not None else input_file.stat().st_size) > size
+
+
+def scan_large_wiki_page(input_file: Path) -> Tuple[WikiPage, bool]:
+    """Read the directives of a page without keeping its body, and whether it can be chunked."""
+    page = WikiPage(input_file)
+    chunkable = True
+    fence = None
     with open(input_file, 'r') as f:
-        content = ''
-        # Retrieve vimwiki placeholders
         for line in f:
             if line.startswith('%nohtml'):
-                sys.exit(0)
-            elif line.startswith('%title'):
-                placeholders['%title%'] = line[7:-1]
-            elif line.startswith('%date'):
-                placeholders['%date%'] = line[6:-1]
-            elif line.startswith('%template'):
-                template = line[10:-1]
-            else:
-                content += line
+                page.nohtml = True
+                return page, False
+            elif read_directive(page, line):
+                continue
+            if fence is None:
+                m = fence_re.match(line)
+                if m:
+                    fence = m.group()
+                    chunkable = chunkable and simple_fence_re.match(line) is not None
+                elif unchunkable_line_re.match(line):
+                    chunkable = False
+            elif line.rstrip('\n').rstrip(' ') == fence:
+                fence = None
+    return page, chunkable
+
+
+def read_wiki_page_chunks(input_file: Path) -> Iterator[str]:
+    """Yield the body of a page in chunks of whole top level blocks.
+
+    A chunk ends before a heading or fence that follows a blank line,
+    once it holds at least chunk_size characters.
+    """
+    page = WikiPage(input_file)
+    chunk: List[str] = []
+    size = 0
+    fence = None
+    blank = True
+    with open(input_file, 'r') as f:
+        for line in f:
+            if read_directive(page, line):
+                continue
+            if fence is None:
+                m = fence_re.match(line)
+                if blank and size >= chunk_size and (m or line.startswith('#')):
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+                if m:
+                    fence = m.group()
+            elif line.rstrip('\n').rstrip(' ') == fence:
+                fence = None
+            chunk.append(line)
+            size += len(line)
+            blank = not line.strip()
+    if chunk:
+        yield ''.join(chunk)
+
+
+def convert_chunks(md: markdown.Markdown, chunks: Iterable[str]) -> Iterator[str]:
+    """Convert chunks one by one, the output is the same as converting them joined.
+
+    md.convert strips its output, so each chunk gets a marker paragraph
+    that is cut off again, keeping the separator markdown puts after the
+    chunk's last block.
+    """
+    marker = f'<p>{chunk_end}</p>'
+    previous = None
+    for chunk in chunks:
+        md.reset()
+        with traced_stage('md.convert'):
+            html = md.convert(chunk + '\n\n' + chunk_end + '\n')
+        if not html.endswith(marker):
+            raise RuntimeError(f'converting a chunk of a large page gave unexpected output: {html[-80:]!r}')
+        html = html[:-len(marker)]
+        if previous is None:
+            html = html.lstrip()
+            if not html:
+                continue
+        else:
+            yield previous
+        previous = html
+    if previous is not None:
+        yield previous.rstrip()
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def process_input_file(md: markdown.Markdown,
+                       input_file: Path,
+                       rel_root_path: str) -> Optional[Tuple[Dict[str, str], WikiPage]]:
+    with traced_stage('read_page'):
+        page = read_wiki_page(input_file)
+    if page.nohtml:
+        return None
+
+    content = convert_body(md, page)
+
+    return (page_placeholders(page, rel_root_path, content), page)
 
-        placeholders['%content%'] =  md.convert(content)
 
-    return (placeholders, template)
+def page_placeholders(page: WikiPage, rel_root_path: str, content: Iterable[str]) -> Dict:
+    return {
+        '%root_path%': rel_root_path,
+        '%title%':     page.title,
+        '%date%':      page.date if page.date is not None else datetime.datetime.today().strftime( '%Y-%m-%d'),
+        '%content%':   content,
+    }
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def copy_css(root_path: Path, options: Dict):
-    css_files = options.get('css_files').split(',')
+def copy_css(root_path: Path, options: Dict, assets: AssetStore):
+    css_files = options.get('css_files', '').split(',')
     for css_file in css_files:
+        if not css_file:
+            continue
         src_dst = css_file.split(':')
         src = Path(src_dst[0])
-        dst = root_path
+        dst = root_path / src.name
         if len(src_dst) > 1:
             dst = root_path / src_dst[1]
 
-        Path(dst.parent).mkdir(parents=True, exist_ok=True)
-        copy_if_newer(src, dst)
+        assets.add(src, dst)
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def render_template(template: str, placeholders: Dict) -> str:
-    for placeholder, value in placeholders.items():
-        template = template.replace(placeholder, value)
-    return template
+def render_template(template, placeholders: Dict) -> str:
+    if isinstance(template, str):
+        template = HtmlTemplate(template)
+    return template.render(placeholders)
 
 
 #******************************************************************************
 #
 #******************************************************************************
-def main():
-    # print(sys.argv)
-    # exit(0)
+def file_signature(path: Path) -> Optional[List[int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def file_hash(path: Path) -> str:
+    source = prefetched_source(path)
+    if source is not None:
+        return source[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class BuildManifest:
+    """Inputs of every converted page, stored in the output root.
+
+    A page is up to date when its source hash, resolved template, options,
+    root path and copied images all match what was recorded when its html
+    was last written. The directives of each page are recorded with the
+    key of its html in the fragment cache, so a page whose template is all
+    that changed is rendered again without converting it.
+    """
+
+    file_name = '.vimwiki_markdown_manifest.json'
+    version = 1
+    # options that do not change the html of a page
+    output_neutral_options = {'css_files', 'asset_mode', 'asset_threads', 'fsync', 'io_threads', 'search_index',
+                              'large_page_size', 'highlight_cache', 'highlight_cache_size', 'fragment_cache',
+                              'fragment_cache_size', 'trace', 'trace_profile'}
+
+    def __init__(self,
+                 root_path: Path,
+                 options: Dict,
+                 template_path: Path,
+                 template_default: str,
+                 template_ext: str,
+                 force: bool = False):
+        self.path = root_path / self.file_name
+        self.options = json.dumps({k: v for k, v in options.items() if k not in self.output_neutral_options},
+                                  sort_keys=True)
+        self.template_path = template_path
+        self.template_default = template_default
+        self.template_ext = template_ext
+        self.force = force
+        self.dirty = False
+        self.skipped = 0
+        self.rendered = 0
+        self.pages: Dict[str, Dict] = {}
+        self.fragment_cache_options = {k: v for k, v in options.items() if k.startswith('fragment_cache')}
+
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+            if stored.get('version') == self.version:
+                self.pages = stored.get('pages', {})
+        except (OSError, ValueError):
+            pass
+
+    def _template_signature(self, requested_template: Optional[str]):
+        tpl_file = resolve_html_template(
+                self.template_path,
+                self.template_default,
+                self.template_ext,
+                requested_template,
+                verbose=False
+        )
+        if tpl_file is None:
+            return [None, None]
+        st = cached_stat(tpl_file)
+        # absolute, pages_using_template compares it with the changed file
+        return [os.path.abspath(tpl_file), [st.st_mtime_ns, st.st_size] if st is not None else None]
+
+    def staleness(self, input_file: Path, output_file: Path, rel_root_path: str) -> Optional[str]:
+        """None for an up to date page, 'template' when only its template changed, else 'source'."""
+        if self.force:
+            return 'source'
+
+        record = self.pages.get(os.path.abspath(input_file))
+        if record is None or not output_file.exists():
+            return 'source'
+
+        if (record['output'] != os.path.abspath(output_file)
+                or record['root_path'] != rel_root_path
+                or record['options'] != self.options
+                or record['source'] != file_hash(input_file)):
+            return 'source'
+
+        for src, dst, signature in record['images']:
+            if file_signature(Path(src)) != signature or not Path(dst).exists():
+                return 'source'
+
+        if record['template'] != self._template_signature(record['requested_template']):
+            return 'template'
+        return None
+
+    def record(self,
+               input_file: Path,
+               output_file: Path,
+               rel_root_path: str,
+               page: WikiPage,
+               images: List[Tuple[Path, Path]]):
+        self.pages[os.path.abspath(input_file)] = {
+            'output': os.path.abspath(output_file),
+            'root_path': rel_root_path,
+            'options': self.options,
+            'source': file_hash(input_file),
+            'requested_template': page.template,
+            'template': self._template_signature(page.template),
+            'images': [[str(src), str(dst), file_signature(src)] for src, dst in images],
+            'title': page.title,
+            'date': page.date,
+            'fragment': page.fragment,
+        }
+        self.dirty = True
+
+    def record_template(self, input_file: Path):
+        """The page was rendered again with the template it resolves to now."""
+        record = self.pages[os.path.abspath(input_file)]
+        record['template'] = self._template_signature(record['requested_template'])
+        self.dirty = True
+
+    def cached_page(self, input_file: Path) -> Optional[WikiPage]:
+        """The directives and content of a page as last converted, if its html is cached."""
+        record = self.pages.get(os.path.abspath(input_file))
+        if record is None or record.get('fragment') is None:
+            return None
+        cache = open_fragment_cache(self.fragment_cache_options)
+        fragment = cache.get_fragment(record['fragment']) if cache is not None else None
+        if fragment is None:
+            return None
+
+        page = WikiPage(input_file)
+        page.title = record['title']
+        page.date = record['date']
+        page.template = record['requested_template']
+        page.fragment = record['fragment']
+        page.content = fragment['content']
+        if fragment['headings'] is not None:
+            page.headings = [tuple(h) for h in fragment['headings']]
+        return page
+
+    def pages_using_template(self, tpl_file: Path) -> List[Path]:
+        """Pages whose template resolution may change when tpl_file changes."""
+        tpl_key = os.path.abspath(tpl_file)
+        tpl_name = tpl_file.name[:-len(self.template_ext)] if self.template_ext else tpl_file.name
+        is_default = tpl_name == self.template_default
+
+        pages = []
+        for key, record in self.pages.items():
+            resolved = record['template'][0]
+            if (resolved == tpl_key
+                    or record['requested_template'] == tpl_name
+                    or (is_default and resolved is None)):
+                pages.append(Path(key))
+        return pages
+
+    def forget(self, input_file: Path):
+        if self.pages.pop(os.path.abspath(input_file), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the vim hook and a watcher may save at the same time
+        tmp = temp_file_path(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'pages': self.pages}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+#******************************************************************************
+#
+#******************************************************************************
+FICLONE = 0x40049409
+
+
+def clone_file(fsrc, fdst) -> bool:
+    """Share the blocks of fsrc with fdst (a reflink), False where the filesystem can not."""
+    try:
+        import fcntl
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def copy_file_data(fsrc, fdst):
+    """Copy the data in the kernel with copy_file_range when it is available."""
+    if hasattr(os, 'copy_file_range'):
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError:
+            # e.g. across filesystems on older kernels, start over with a plain copy
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def copy_asset(src: Path, dst: Path, mode: str):
+    """Replace dst with src, hardlinked, reflinked or copied as mode asks.
+
+    Links and clones fall back to a copy where they are not supported.
+    The new file is moved into place, readers never see a partial copy.
+    """
+    ensure_dir(dst.parent)
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+    try:
+        linked = False
+        if mode == 'hardlink':
+            try:
+                os.link(src, tmp)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                if not (mode == 'reflink' and clone_file(fsrc, fdst)):
+                    copy_file_data(fsrc, fdst)
+            shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class AssetStore:
+    """Images and stylesheets copied into the output root, with a manifest.
+
+    Every destination is handled once per run however many pages refer
+    to it. The manifest remembers the signature and hash of each source,
+    so an unchanged asset costs a stat and a touched but identical one a
+    hash instead of a copy. Copies run on a thread pool.
+    """
+
+    file_name = '.vimwiki_markdown_assets.json'
+    version = 1
+    modes = ('copy', 'hardlink', 'reflink')
+
+    def __init__(self, root_path: Path, mode: str = 'copy', threads: int = 1):
+        if mode not in self.modes:
+            raise ValueError(f'unknown asset_mode {mode!r}, expected one of {", ".join(self.modes)}')
+        self.path = root_path / self.file_name
+        self.mode = mode
+        self.threads = threads
+        self.executor = None
+        self.pending = []
+        self.handled: Set[str] = set()
+        self.copied = 0
+        self.dirty = False
+        self.assets: Dict[str, Dict] = {}
+
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+            if stored.get('version') == self.version:
+                self.assets = stored.get('assets', {})
+        except (OSError, ValueError):
+            pass
+
+    def add(self, src: Path, dst: Path):
+        key = os.path.abspath(dst)
+        if key in self.handled:
+            return
+        self.handled.add(key)
+
+        if self.threads <= 1:
+            with traced_stage('assets'):
+                self.copied += self.sync(Path(os.path.abspath(src)), Path(key))
+            return
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.pending.append(self.executor.submit(self.sync, Path(os.path.abspath(src)), Path(key)))
+
+    def sync(self, src: Path, dst: Path) -> bool:
+        """Bring dst up to date with src, returns whether anything was copied."""
+        record = self.assets.get(str(dst))
+        signature = file_signature(src)
+        if signature is None:
+            eprint(f'asset not found: {src}')
+            return False
+
+        if record is not None and record['source'] == str(src) and file_signature(dst) == record['output']:
+            if record['signature'] == signature:
+                return False
+            # touched but maybe not changed, the hash decides
+            if record['signature'][1] == signature[1] and record['hash'] == file_hash(src):
+                self.assets[str(dst)] = dict(record, signature=signature)
+                self.dirty = True
+                return False
+
+        digest = file_hash(src)
+        if record is None and file_signature(dst) is not None and digest == file_hash(dst):
+            # copied before the manifest existed
+            copied = False
+        else:
+            copy_asset(src, dst, self.mode)
+            copied = True
+        self.assets[str(dst)] = {
+            'source': str(src),
+            'signature': signature,
+            'hash': digest,
+            'output': file_signature(dst),
+        }
+        self.dirty = True
+        return copied
+
+    def finish(self) -> int:
+        """Wait for the copies, save the manifest and start a new run, returns the copy count."""
+        with traced_stage('assets'):
+            for future in self.pending:
+                self.copied += future.result()
+        copied = self.copied
+        self.pending = []
+        self.handled = set()
+        self.copied = 0
+        self.save()
+        return copied
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the vim hook and a watcher may save at the same time
+        tmp = temp_file_path(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'assets': self.assets}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def open_asset_store(root_path: Path, options: Dict, threads: Optional[int] = None) -> AssetStore:
+    if threads is None:
+        threads = options.get('asset_threads', 4)
+    return AssetStore(root_path, options.get('asset_mode', 'copy'), threads)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class PageIndex(abc.ABC):
+    """An index with a row per page in a sqlite database of the output root.
+
+    Subclasses name the database and the table holding the page and
+    source columns, and create their tables.
+    """
+
+    file_name = ''
+    pages_table = 'pages'
+
+    def __init__(self, root_path: Path):
+        self.root_path = root_path
+        self.created = not (root_path / self.file_name).exists()
+        self.db = open_sqlite(root_path / self.file_name)
+
+    def page_key(self, output_file: Path) -> str:
+        return Path(os.path.relpath(output_file, self.root_path)).as_posix()
+
+    @abc.abstractmethod
+    def forget(self, page: str):
+        """Drop the rows of page."""
+
+    def prune(self, sources: Set[str]):
+        """Drop pages whose source is no longer part of the wiki."""
+        for page, source in self.db.execute(f'SELECT page, source FROM {self.pages_table}').fetchall():
+            if source not in sources:
+                self.forget(page)
+
+
+class LinkIndex(PageIndex):
+    """Links and image references of every page, stored in the output root.
+
+    Pages are identified by their html path relative to the output root,
+    and each page's rows are replaced whenever it is converted, so the
+    index stays current without rescanning the wiki.
+    """
+
+    file_name = '.vimwiki_markdown_links.sqlite'
+
+    def __init__(self, root_path: Path):
+        super().__init__(root_path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages '
+                        '(page TEXT PRIMARY KEY, source TEXT NOT NULL, title TEXT NOT NULL, backlinks TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS links '
+                        '(source TEXT NOT NULL, target TEXT NOT NULL, kind TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_source ON links (source)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_target ON links (target)')
+
+    @staticmethod
+    def resolve(page: str, href: str) -> Optional[str]:
+        """The output path href points to from page, None for a link outside the wiki."""
+        import urllib.parse
+
+        if urllib.parse.urlsplit(href).scheme:
+            return None
+        href = urllib.parse.unquote(href.split('#', 1)[0])
+        if href.startswith('/'):
+            return posixpath.normpath(href.lstrip('/'))
+        return posixpath.normpath(posixpath.join(posixpath.dirname(page), href))
+
+    @staticmethod
+    def rel_root_path(page: str) -> str:
+        return '../' * page.count('/')
+
+    def update_page(self, page: str, source: Path, title: str, links: List[str], images: List[Path]):
+        targets = [self.resolve(page, href) for href in links if href.split('#', 1)[0]]
+        rows = [(page, target, 'link') for target in targets if target is not None]
+        rows += [(page, self.page_key(image), 'image') for image in images]
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.execute('DELETE FROM links WHERE source = ?', (page,))
+        self.db.executemany('INSERT INTO links VALUES (?, ?, ?)', rows)
+        self.db.execute('INSERT INTO pages (page, source, title) VALUES (?, ?, ?) '
+                        'ON CONFLICT (page) DO UPDATE SET source = excluded.source, title = excluded.title',
+                        (page, os.path.abspath(source), title))
+        self.db.execute('COMMIT')
+
+    def forget(self, page: str):
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.execute('DELETE FROM links WHERE source = ?', (page,))
+        self.db.execute('DELETE FROM pages WHERE page = ?', (page,))
+        self.db.execute('COMMIT')
+
+    def backlinks(self, page: str) -> List[Tuple[str, str]]:
+        targets = [page]
+        if posixpath.basename(page) == 'index.html':
+            targets.append(posixpath.dirname(page) or '.')
+        return self.db.execute(
+                'SELECT DISTINCT links.source, pages.title FROM links JOIN pages ON pages.page = links.source '
+                f'WHERE links.kind = \'link\' AND links.source != ? AND links.target IN ({",".join("?" * len(targets))}) '
+                'ORDER BY links.source',
+                [page] + targets).fetchall()
+
+    def backlinks_html(self, page: str, rel_root_path: str) -> str:
+        items = ''.join(f'<li><a href="{escape_html(rel_root_path + source)}">{escape_html(title)}</a></li>'
+                        for source, title in self.backlinks(page))
+        return f'<ul class="backlinks">{items}</ul>' if items else ''
+
+    def set_rendered_backlinks(self, page: str, backlinks: Optional[str]):
+        self.db.execute('UPDATE pages SET backlinks = ? WHERE page = ?', (backlinks, page))
+
+    def stale_backlinks(self) -> List[Tuple[str, Path]]:
+        """Pages rendered with backlinks that no longer match the index."""
+        stale = []
+        for page, source, rendered in self.db.execute(
+                'SELECT page, source, backlinks FROM pages WHERE backlinks IS NOT NULL').fetchall():
+            if self.backlinks_html(page, self.rel_root_path(page)) != rendered:
+                stale.append((page, Path(source)))
+        return stale
+
+    def broken_links(self) -> List[Tuple[str, str]]:
+        pages = {row[0] for row in self.db.execute('SELECT page FROM pages')}
+        broken = []
+        for source, target, kind in self.db.execute('SELECT source, target, kind FROM links ORDER BY source, target'):
+            if kind == 'link' and (target in pages or posixpath.normpath(posixpath.join(target, 'index.html')) in pages):
+                continue
+            if not (self.root_path / target).exists():
+                broken.append((source, target))
+        return broken
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def open_link_index(root_path: Path, options: Dict) -> Optional[LinkIndex]:
+    if not options.get('link_index', False):
+        return None
+    return LinkIndex(root_path)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class SearchIndex(PageIndex):
+    """Inverted index of the words of every page, stored in the output root.
+
+    The postings are kept in sqlite so converting a single page updates
+    them in place. The json shards under search/, one per two letter term
+    prefix, are what the bundled search.js fetches; write() rewrites only
+    the shards whose terms changed.
+    """
+
+    file_name = '.vimwiki_markdown_search.sqlite'
+    pages_table = 'docs'
+    dir_name = 'search'
+    word_re = re.compile(r'\w{2,}')
+    max_term_length = 40
+
+    def __init__(self, root_path: Path):
+        super().__init__(root_path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs '
+                        '(id INTEGER PRIMARY KEY, page TEXT NOT NULL UNIQUE, source TEXT NOT NULL, title TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS postings '
+                        '(term TEXT NOT NULL, shard TEXT NOT NULL, doc INTEGER NOT NULL, count INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS postings_shard ON postings (shard)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)')
+        # shards to write, '' stands for docs.json
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirty (shard TEXT PRIMARY KEY)')
+
+    @classmethod
+    def terms(cls, text: str) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for word in cls.word_re.findall(text.lower()):
+            if len(word) <= cls.max_term_length:
+                counts[word] = counts.get(word, 0) + 1
+        return counts
+
+    @staticmethod
+    def shard(term: str) -> str:
+        return term[:2].encode('utf-8').hex()
+
+    @staticmethod
+    def html_text(html: str) -> str:
+        return unescape_html(re.sub(r'<[^>]*>', ' ', html))
+
+    def count_terms(self, chunks: Iterable[str], counts: Dict[str, int]) -> Iterator[str]:
+        """Yield html chunks unchanged, adding the terms of their text to counts."""
+        for chunk in chunks:
+            for term, count in self.terms(self.html_text(chunk)).items():
+                counts[term] = counts.get(term, 0) + count
+            yield chunk
+
+    def update_page(self, page: str, source: Path, title: str, html: str):
+        self.update_terms(page, source, title, self.terms(title + ' ' + self.html_text(html)))
+
+    def update_terms(self, page: str, source: Path, title: str, counts: Dict[str, int]):
+        self.db.execute('BEGIN IMMEDIATE')
+        row = self.db.execute('SELECT id, title FROM docs WHERE page = ?', (page,)).fetchone()
+        if row is None:
+            doc = self.db.execute('INSERT INTO docs (page, source, title) VALUES (?, ?, ?)',
+                                  (page, os.path.abspath(source), title)).lastrowid
+            old: Dict[str, int] = {}
+            self.db.execute('INSERT OR IGNORE INTO dirty VALUES (\'\')')
+        else:
+            doc = row[0]
+            self.db.execute('UPDATE docs SET source = ?, title = ? WHERE id = ?', (os.path.abspath(source), title, doc))
+            old = dict(self.db.execute('SELECT term, count FROM postings WHERE doc = ?', (doc,)))
+            if row[1] != title:
+                self.db.execute('INSERT OR IGNORE INTO dirty VALUES (\'\')')
+
+        changed = {term for term in old.keys() | counts.keys() if old.get(term) != counts.get(term)}
+        if changed:
+            self.db.execute('DELETE FROM postings WHERE doc = ?', (doc,))
+            self.db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)',
+                                [(term, self.shard(term), doc, count) for term, count in counts.items()])
+            self.db.executemany('INSERT OR IGNORE INTO dirty VALUES (?)', [(s,) for s in {self.shard(t) for t in changed}])
+        self.db.execute('COMMIT')
+
+    def forget(self, page: str):
+        self.db.execute('BEGIN IMMEDIATE')
+        row = self.db.execute('SELECT id FROM docs WHERE page = ?', (page,)).fetchone()
+        if row is not None:
+            shards = {(shard,) for shard, in self.db.execute('SELECT shard FROM postings WHERE doc = ?', row)}
+            self.db.executemany('INSERT OR IGNORE INTO dirty VALUES (?)', shards | {('',)})
+            self.db.execute('DELETE FROM postings WHERE doc = ?', row)
+            self.db.execute('DELETE FROM docs WHERE id = ?', row)
+        self.db.execute('COMMIT')
+
+    def write(self) -> int:
+        """Write the shards that changed since the last write, returns how many."""
+        out = self.root_path / self.dir_name
+        self.db.execute('BEGIN IMMEDIATE')
+        shards = [shard for shard, in self.db.execute('SELECT shard FROM dirty')]
+        if shards:
+            out.mkdir(parents=True, exist_ok=True)
+            write_to_file(out / 'search.js', search_js)
+        for shard in shards:
+            if shard == '':
+                pages = {str(doc): [page, title] for doc, page, title in
+                         self.db.execute('SELECT id, page, title FROM docs ORDER BY id')}
+                write_to_file(out / 'docs.json', json.dumps({'count': len(pages), 'pages': pages}, separators=(',', ':')))
+                continue
+
+            terms: Dict[str, List[List[int]]] = {}
+            for term, doc, count in self.db.execute(
+                    'SELECT term, doc, count FROM postings WHERE shard = ? ORDER BY term, doc', (shard,)):
+                terms.setdefault(term, []).append([doc, count])
+            shard_file = out / (shard + '.json')
+            if terms:
+                write_to_file(shard_file, json.dumps(terms, separators=(',', ':')))
+            elif shard_file.exists():
+                shard_file.unlink()
+        self.db.execute('DELETE FROM dirty')
+        self.db.execute('COMMIT')
+        return len(shards)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def open_search_index(root_path: Path, options: Dict) -> Optional[SearchIndex]:
+    if not options.get('search_index', False):
+        return None
+    return SearchIndex(root_path)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class HeadingIndex(PageIndex):
+    """Title and headings of every page, stored in the output root.
+
+    The index.html and diary/diary.html pages linked from the default
+    template are rendered from it, unless the wiki has pages of its own
+    for them, without reading any page source. Each page's rows are
+    replaced when it is converted and write() renders only the generated
+    pages whose entries changed.
+    """
+
+    file_name = '.vimwiki_markdown_headings.sqlite'
+    index_page = 'index.html'
+    diary_page = 'diary/diary.html'
+    diary_entry_re = re.compile(r'diary/(\d{4})-(\d{2})-\d{2}\.html$')
+    # deeper headings are only listed in the page's own %toc%
+    index_depth = 3
+    # marks the html written by write(), any other file is left alone
+    generated_marker = '<!-- generated by vimwiki_markdown from the heading index -->'
+
+    def __init__(self, root_path: Path):
+        super().__init__(root_path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages '
+                        '(page TEXT PRIMARY KEY, source TEXT NOT NULL, title TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS headings '
+                        '(page TEXT NOT NULL, position INTEGER NOT NULL, level INTEGER NOT NULL, '
+                        'text TEXT NOT NULL, anchor TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS headings_page ON headings (page)')
+        # generated pages to render again
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirty (page TEXT PRIMARY KEY)')
+
+    def listed_on(self, page: str) -> str:
+        return self.diary_page if self.diary_entry_re.match(page) else self.index_page
+
+    def update_page(self, page: str, source: Path, title: str, headings: List[Tuple[int, str, str]]):
+        self.db.execute('BEGIN IMMEDIATE')
+        row = self.db.execute('SELECT title FROM pages WHERE page = ?', (page,)).fetchone()
+        old = self.db.execute('SELECT level, text, anchor FROM headings WHERE page = ? ORDER BY position',
+                              (page,)).fetchall()
+        self.db.execute('INSERT INTO pages (page, source, title) VALUES (?, ?, ?) '
+                        'ON CONFLICT (page) DO UPDATE SET source = excluded.source, title = excluded.title',
+                        (page, os.path.abspath(source), title))
+        if row is None or row[0] != title or old != [tuple(h) for h in headings]:
+            self.db.execute('DELETE FROM headings WHERE page = ?', (page,))
+            self.db.executemany('INSERT INTO headings VALUES (?, ?, ?, ?, ?)',
+                                [(page, i, level, text, anchor) for i, (level, text, anchor) in enumerate(headings)])
+            self.db.execute('INSERT OR IGNORE INTO dirty VALUES (?)', (self.listed_on(page),))
+        self.db.execute('COMMIT')
+
+    def forget(self, page: str):
+        self.db.execute('BEGIN IMMEDIATE')
+        if self.db.execute('DELETE FROM pages WHERE page = ?', (page,)).rowcount:
+            self.db.execute('DELETE FROM headings WHERE page = ?', (page,))
+            self.db.execute('INSERT OR IGNORE INTO dirty VALUES (?)', (self.listed_on(page),))
+        self.db.execute('COMMIT')
+
+    def template_changed(self):
+        """The default template changed, render the generated pages again."""
+        for page in (self.index_page, self.diary_page):
+            if (self.root_path / page).exists():
+                self.db.execute('INSERT OR IGNORE INTO dirty VALUES (?)', (page,))
+
+    def index_html(self) -> str:
+        headings: Dict[str, List[Tuple[int, str, str]]] = {}
+        for page, level, text, anchor in self.db.execute(
+                'SELECT page, level, text, anchor FROM headings WHERE level <= ? ORDER BY page, position',
+                (self.index_depth,)):
+            headings.setdefault(page, []).append((level, text, anchor))
+        items = []
+        for page, title in self.db.execute('SELECT page, title FROM pages ORDER BY page'):
+            if page == self.index_page or self.diary_entry_re.match(page):
+                continue
+            items.append(f'<li><a href="{escape_html(page)}">{escape_html(title)}</a>'
+                         f'{toc_html(headings.get(page, []), page)}</li>')
+        return f'<h1>Index</h1>\n<ul class="index">{"".join(items)}</ul>'
+
+    def diary_html(self) -> str:
+        parts = ['<h1>Diary</h1>']
+        year = month = None
+        for page, title in self.db.execute('SELECT page, title FROM pages ORDER BY page DESC'):
+            m = self.diary_entry_re.match(page)
+            if m is None:
+                continue
+            if m.group(1) != year:
+                if month is not None:
+                    parts.append('</ul>')
+                year, month = m.group(1), None
+                parts.append(f'<h2>{year}</h2>')
+            if m.group(2) != month:
+                if month is not None:
+                    parts.append('</ul>')
+                month = m.group(2)
+                parts.append(f'<h3>{datetime.date(2000, int(month), 1).strftime("%B")}</h3><ul>')
+            parts.append(f'<li><a href="{escape_html(posixpath.basename(page))}">{escape_html(title)}</a></li>')
+        if month is not None:
+            parts.append('</ul>')
+        return '\n'.join(parts)
+
+    def has_source(self, page: str) -> bool:
+        """Whether the wiki has a page of its own for the generated page."""
+        if self.db.execute('SELECT 1 FROM pages WHERE page = ?', (page,)).fetchone() is not None:
+            return True
+        # the page was not converted (%nohtml, or before the index was
+        # enabled), look for its source next to the ones that were
+        row = self.db.execute('SELECT page, source FROM pages LIMIT 1').fetchone()
+        if row is None:
+            return False
+        source = Path(row[1])
+        wiki_root = source.parents[row[0].count('/')]
+        return (wiki_root / page).with_suffix(source.suffix).exists()
+
+    def is_generated(self, output_file: Path) -> bool:
+        try:
+            with open(output_file, encoding='utf8') as f:
+                return self.generated_marker in f.read()
+        except FileNotFoundError:
+            return True
+
+    def write(self, templates: Tuple) -> int:
+        """Render the generated pages whose entries changed, returns how many were written."""
+        self.db.execute('BEGIN IMMEDIATE')
+        dirty = [page for page, in self.db.execute('SELECT page FROM dirty ORDER BY page')]
+        written = 0
+        for page in dirty:
+            output_file = self.root_path / page
+            if self.has_source(page) or not self.is_generated(output_file):
+                continue
+            title, content = ('Index', self.index_html()) if page == self.index_page else ('Diary', self.diary_html())
+            rel_root_path = LinkIndex.rel_root_path(page)
+            tpl_file = resolve_html_template(*templates, None, verbose=False)
+            template = read_html_template(tpl_file) if tpl_file else apply_defaults(self.root_path)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            write_to_file(output_file, template.render({
+                '%root_path%': rel_root_path,
+                '%title%':     title,
+                '%date%':      datetime.datetime.today().strftime('%Y-%m-%d'),
+                '%content%':   f'{self.generated_marker}\n{content}',
+                '%backlinks%': '',
+                '%toc%':       '',
+            }))
+            written += 1
+        self.db.execute('DELETE FROM dirty')
+        self.db.execute('COMMIT')
+        return written
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def open_heading_index(root_path: Path, options: Dict) -> Optional[HeadingIndex]:
+    if not options.get('heading_index', False):
+        return None
+    return HeadingIndex(root_path)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def page_output_file(input_file: Path, output_dir: Path) -> Path:
+    return output_dir / Path(input_file.stem + '.html')
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def render_page(md: markdown.Markdown,
+                input_file: Path,
+                output_dir: Path,
+                rel_root_path: str,
+                template_path: Path,
+                template_default: str,
+                template_ext: str,
+                links: Optional[LinkIndex] = None,
+                search: Optional[SearchIndex] = None,
+                headings: Optional[HeadingIndex] = None) -> Optional[WikiPage]:
+    """Convert and write a single wiki page.
+
+    Returns the page that was written, or None if the page asked for %nohtml.
+    With a link index the page's links are recorded and its %backlinks%
+    are filled in from the index. With a search index its words are indexed,
+    with a heading index its title and headings.
+    """
+    with traced_page(str(input_file)):
+        return write_page(md, input_file, output_dir, rel_root_path, template_path, template_default, template_ext,
+                          links, search, headings)
+
+
+def write_page(md: markdown.Markdown,
+               input_file: Path,
+               output_dir: Path,
+               rel_root_path: str,
+               template_path: Path,
+               template_default: str,
+               template_ext: str,
+               links: Optional[LinkIndex],
+               search: Optional[SearchIndex],
+               headings: Optional[HeadingIndex]) -> Optional[WikiPage]:
+    root_path = output_dir / rel_root_path
+    output_file = page_output_file(input_file, output_dir)
+
+    page, chunked = None, False
+    if is_large_page(md, input_file):
+        with traced_stage('read_page'):
+            page, chunked = scan_large_wiki_page(input_file)
+    if page is not None and page.nohtml:
+        processed = None
+    elif chunked:
+        processed = (page_placeholders(page, rel_root_path, ''), page)
+    else:
+        processed = process_input_file(md, input_file, rel_root_path)
+    if processed is None:
+        if links is not None:
+            links.forget(links.page_key(output_file))
+        if search is not None:
+            search.forget(search.page_key(output_file))
+        if headings is not None:
+            headings.forget(headings.page_key(output_file))
+        return None
+    placeholders, page = processed
+
+    with traced_stage('template_lookup'):
+        template = try_read_html_template(
+                template_path,
+                template_default,
+                template_ext,
+                page.template
+        ) or apply_defaults(root_path)
+
+    if chunked and (template.segments.count('%content%') != 1 or '%toc%' in template.placeholders):
+        # the converted chunks can only be written once, and the toc is known after them
+        chunked = False
+        placeholders, page = process_input_file(md, input_file, rel_root_path)
+
+    if links is not None:
+        page_key = links.page_key(output_file)
+        backlinks = None
+        if '%backlinks%' in template.placeholders:
+            with traced_stage('link_index'):
+                backlinks = links.backlinks_html(page_key, rel_root_path)
+            placeholders['%backlinks%'] = backlinks
+
+    if chunked:
+        content = convert_chunks(md, read_wiki_page_chunks(input_file))
+        if search is not None:
+            counts = search.terms(page.title)
+            content = search.count_terms(content, counts)
+        placeholders['%content%'] = content
+        with traced_stage('write_to_file'):
+            write_chunks_to_file(output_file, template.stream(placeholders))
+        if search is not None:
+            with traced_stage('search_index'):
+                search.update_terms(search.page_key(output_file), input_file, page.title, counts)
+    else:
+        if search is not None:
+            with traced_stage('search_index'):
+                search.update_page(search.page_key(output_file), input_file, page.title, placeholders['%content%'])
+
+        if '%toc%' in template.placeholders and recorded_headings(md) is not None:
+            placeholders['%toc%'] = toc_html(recorded_headings(md))
+
+        with traced_stage('render_template'):
+            html = render_template(template, placeholders)
+
+        with traced_stage('write_to_file'):
+            write_output(output_file, html)
+
+    if links is not None:
+        # the links are known once the page is converted, backlinks never include the page itself
+        with traced_stage('link_index'):
+            images = [dst for _, dst in copied_images(md)]
+            links.update_page(page_key, input_file, page.title, recorded_links(md), images)
+            links.set_rendered_backlinks(page_key, backlinks)
+
+    page.headings = recorded_headings(md)
+    if headings is not None and page.headings is not None:
+        with traced_stage('heading_index'):
+            headings.update_page(headings.page_key(output_file), input_file, page.title, page.headings)
+    return page
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def convert_page(md: markdown.Markdown,
+                 input_file: Path,
+                 output_dir: Path,
+                 rel_root_path: str,
+                 template_path: Path,
+                 template_default: str,
+                 template_ext: str,
+                 manifest: Optional[BuildManifest] = None,
+                 links: Optional[LinkIndex] = None,
+                 assets: Optional[AssetStore] = None,
+                 search: Optional[SearchIndex] = None,
+                 headings: Optional[HeadingIndex] = None) -> bool:
+    """Convert a single wiki page, returns False if the page asked for %nohtml.
+
+    With a manifest, pages whose inputs did not change since the last
+    conversion are left alone. The page's images are handed to assets.
+    """
+    output_file = page_output_file(input_file, output_dir)
+
+    with traced_stage('manifest'):
+        staleness = manifest.staleness(input_file, output_file, rel_root_path) if manifest is not None else 'source'
+    if staleness is None:
+        manifest.skipped += 1
+        return True
+    if staleness == 'template' and rerender_cached_page(input_file, output_dir, rel_root_path,
+                                                        template_path, template_default, template_ext,
+                                                        manifest, links):
+        return True
+
+    page = render_page(md,
+                       input_file,
+                       output_dir,
+                       rel_root_path,
+                       template_path,
+                       template_default,
+                       template_ext,
+                       links,
+                       search,
+                       headings)
+    if page is None:
+        if manifest is not None:
+            manifest.forget(input_file)
+        return False
+
+    if assets is not None:
+        for src, dst in copied_images(md):
+            assets.add(src, dst)
+    if manifest is not None:
+        manifest.record(input_file, output_file, rel_root_path, page, copied_images(md))
+    return True
+
+
+def rerender_cached_page(input_file: Path,
+                         output_dir: Path,
+                         rel_root_path: str,
+                         template_path: Path,
+                         template_default: str,
+                         template_ext: str,
+                         manifest: BuildManifest,
+                         links: Optional[LinkIndex] = None) -> bool:
+    """Render a page whose template changed from its cached content, False if none is cached.
+
+    The content, links and headings of the page are the same as when it
+    was converted, so markdown is not run and the indexes are left alone.
+    """
+    page = manifest.cached_page(input_file)
+    if page is None:
+        return False
+
+    with traced_page(str(input_file)):
+        root_path = output_dir / rel_root_path
+        output_file = page_output_file(input_file, output_dir)
+        with traced_stage('template_lookup'):
+            template = try_read_html_template(
+                    template_path,
+                    template_default,
+                    template_ext,
+                    page.template
+            ) or apply_defaults(root_path)
+
+        placeholders = page_placeholders(page, rel_root_path, page.content)
+        if links is not None:
+            with traced_stage('link_index'):
+                page_key = links.page_key(output_file)
+                backlinks = None
+                if '%backlinks%' in template.placeholders:
+                    backlinks = links.backlinks_html(page_key, rel_root_path)
+                    placeholders['%backlinks%'] = backlinks
+                links.set_rendered_backlinks(page_key, backlinks)
+        if '%toc%' in template.placeholders and page.headings is not None:
+            placeholders['%toc%'] = toc_html(page.headings)
+
+        with traced_stage('render_template'):
+            html = render_template(template, placeholders)
+        with traced_stage('write_to_file'):
+            write_output(output_file, html)
+
+    manifest.record_template(input_file)
+    manifest.rendered += 1
+    return True
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def find_wiki_pages(wiki_root: Path, extension: str, exclude: Path):
+    """Yield every page below wiki_root, skipping the exclude dir (the html output)."""
+    exclude = exclude.resolve()
+    for dirpath, dirnames, filenames in os.walk(wiki_root):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if not d.startswith('.') and (Path(dirpath) / d).resolve() != exclude
+        )
+        for filename in sorted(filenames):
+            if filename.endswith(extension):
+                yield Path(dirpath) / filename
+
+
+#******************************************************************************
+#
+#******************************************************************************
+BatchJob = Tuple[Path, Path, str]
+
+
+def batch_job(wiki_root: Path, output_root: Path, input_file: Path) -> BatchJob:
+    """Output dir and relative root path of a page, mirroring the wiki tree."""
+    rel_dir = input_file.parent.relative_to(wiki_root)
+    output_dir = output_root / rel_dir
+    rel_root_path = '../' * len(rel_dir.parts)
+
+    ensure_dir(output_dir)
+    return (input_file, output_dir, rel_root_path)
+
+
+def convert_pages(jobs: List[BatchJob],
+                  md: markdown.Markdown,
+                  templates: Tuple,
+                  manifest: BuildManifest,
+                  assets: AssetStore,
+                  links: Optional[LinkIndex] = None,
+                  search: Optional[SearchIndex] = None,
+                  headings: Optional[HeadingIndex] = None) -> Tuple[int, Dict[str, Tuple[int, int]]]:
+    pages = manifest.skipped
+    for input_file, output_dir, rel_root_path in read_ahead(jobs):
+        rebind_markdown_converter(md, input_file.parent, output_dir)
+        if convert_page(md, input_file, output_dir, rel_root_path, *templates, manifest, links, assets, search,
+                        headings):
+            pages += 1
+    return pages - manifest.skipped - manifest.rendered, cache_counts()
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def update_backlinks(md: markdown.Markdown,
+                     links: LinkIndex,
+                     templates: Tuple,
+                     wiki_root: Path,
+                     output_root: Path) -> int:
+    """Render again the pages whose backlinks changed since they were written."""
+    pages = 0
+    for _, input_file in links.stale_backlinks():
+        if not input_file.is_file():
+            continue
+        input_file, output_dir, rel_root_path = batch_job(wiki_root, output_root, input_file)
+        rebind_markdown_converter(md, input_file.parent, output_dir)
+        render_page(md, input_file, output_dir, rel_root_path, *templates, links)
+        pages += 1
+    return pages
+
+
+#******************************************************************************
+#
+#******************************************************************************
+worker_state: Dict = {}
+
+
+def init_batch_worker(options: Dict,
+                      templates: Tuple,
+                      defaults: Set[str],
+                      links_root: Optional[Path],
+                      search_root: Optional[Path],
+                      headings_root: Optional[Path]):
+    global trace, batch_io
+    # a forked worker starts with a copy of the parent's trace, io threads and cache connections, start over
+    trace = None
+    batch_io = None
+    highlight_caches.clear()
+    fragment_caches.clear()
+    enable_trace(options)
+    set_fsync_policy(options)
+    worker_state['md'] = setup_markdown_converter(options, Path(), Path())
+    worker_state['templates'] = templates
+    worker_state['links'] = LinkIndex(links_root) if links_root is not None else None
+    worker_state['search'] = SearchIndex(search_root) if search_root is not None else None
+    worker_state['headings'] = HeadingIndex(headings_root) if headings_root is not None else None
+    applied_defaults.update(defaults)
+
+
+def highlight_cache_counts() -> Tuple[int, int]:
+    cache = CachedCodeHilite.cache if CachedCodeHilite is not None else None
+    if cache is None:
+        return (0, 0)
+    return (cache.hits, cache.misses)
+
+
+def cache_counts() -> Dict[str, Tuple[int, int]]:
+    """Hits and misses of the caches of this process, by name."""
+    return {'highlight': highlight_cache_counts(), 'fragment': fragment_cache_counts()}
+
+
+def run_batch_worker(job: BatchJob):
+    input_file, output_dir, rel_root_path = job
+    md = worker_state['md']
+    before = cache_counts()
+    rebind_markdown_converter(md, input_file.parent, output_dir)
+    page = render_page(md, input_file, output_dir, rel_root_path, *worker_state['templates'],
+                       worker_state['links'], worker_state['search'], worker_state['headings'])
+    if page is not None:
+        # the parent only needs the directives, not the body
+        page.body = ''
+    stats = {
+        'caches': {name: (hits - before[name][0], misses - before[name][1])
+                   for name, (hits, misses) in cache_counts().items()},
+        'trace': trace.last_record if trace is not None else None,
+    }
+    return job, page, copied_images(md), stats
+
+
+def run_backlinks_worker(job: BatchJob):
+    input_file, output_dir, rel_root_path = job
+    md = worker_state['md']
+    rebind_markdown_converter(md, input_file.parent, output_dir)
+    render_page(md, input_file, output_dir, rel_root_path, *worker_state['templates'], worker_state['links'])
+
+
+def convert_pages_parallel(jobs: List[BatchJob],
+                           options: Dict,
+                           templates: Tuple,
+                           manifest: BuildManifest,
+                           assets: AssetStore,
+                           processes: int,
+                           links: Optional[LinkIndex] = None,
+                           search: Optional[SearchIndex] = None,
+                           headings: Optional[HeadingIndex] = None) -> Tuple[int, int, Dict[str, Tuple[int, int]]]:
+    """Convert pages on a pool of worker processes, one converter per worker.
+
+    Shared side effects stay in this process: the default stylesheet is
+    written before the workers start and images are handed to assets as
+    the results come back. With a link index the pages whose backlinks
+    changed are rendered again on the same workers, returns the number of
+    pages converted, of pages rendered again and the cache counts.
+    """
+    import multiprocessing
+
+    stale = []
+    for job in jobs:
+        input_file, output_dir, rel_root_path = job
+        staleness = manifest.staleness(input_file, page_output_file(input_file, output_dir), rel_root_path)
+        if staleness is None:
+            manifest.skipped += 1
+        elif not (staleness == 'template' and rerender_cached_page(*job, *templates, manifest, links)):
+            stale.append(job)
+
+    counts = {name: (0, 0) for name in cache_counts()}
+    # pages whose only change is a backlink, e.g. to a deleted page
+    if not stale and not stale_backlink_jobs(jobs, links):
+        return 0, 0, counts
+
+    if resolve_html_template(templates[0], templates[1], templates[2], None, verbose=False) is None:
+        for _, output_dir, rel_root_path in jobs:
+            apply_defaults(output_dir / rel_root_path)
+
+    if batch_io is not None:
+        # finish the writes of the rerenders first, forking while the writer
+        # thread holds a lock would leave it held in the workers
+        batch_io.close()
+
+    pages = 0
+    chunksize = max(1, len(stale) // (processes * 8))
+    with multiprocessing.Pool(processes,
+                              initializer=init_batch_worker,
+                              initargs=(options, templates, applied_defaults,
+                                        links.root_path if links is not None else None,
+                                        search.root_path if search is not None else None,
+                                        headings.root_path if headings is not None else None)) as pool:
+        for job, page, images, stats in pool.imap_unordered(run_batch_worker, stale, chunksize):
+            input_file, output_dir, rel_root_path = job
+            for name, (hits, misses) in stats['caches'].items():
+                counts[name] = (counts[name][0] + hits, counts[name][1] + misses)
+            if trace is not None and stats['trace'] is not None:
+                trace.merge(stats['trace'])
+            if page is None:
+                manifest.forget(input_file)
+                continue
+            for src, dst in images:
+                assets.add(src, dst)
+            pages += 1
+            manifest.record(input_file,
+                            page_output_file(input_file, output_dir),
+                            rel_root_path,
+                            page,
+                            images)
+
+        # the backlinks are only known once every page is indexed
+        backlink_jobs = stale_backlink_jobs(jobs, links)
+        pool.map(run_backlinks_worker, backlink_jobs, max(1, len(backlink_jobs) // (processes * 8)))
+    return pages, len(backlink_jobs), counts
+
+
+def stale_backlink_jobs(jobs: List[BatchJob], links: Optional[LinkIndex]) -> List[BatchJob]:
+    """The jobs of the pages rendered with backlinks that no longer match the index."""
+    if links is None:
+        return []
+    by_source = {os.path.abspath(job[0]): job for job in jobs}
+    return [by_source[str(source)] for _, source in links.stale_backlinks() if str(source) in by_source]
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='vimwiki_markdown batch',
+                                     description='Convert a whole wiki tree to html in one process.')
+    parser.add_argument('wiki_root',           type=Path, help='full path to the wiki source directory.')
+    parser.add_argument('output_root',         type=Path, help='full path to the html output root directory.')
+    parser.add_argument('template_path',       type=Path, help='full path to directory with html templates.')
+    parser.add_argument('template_default',    type=str,  help='default html template file name. (without extension).')
+    parser.add_argument('template_ext',        type=str,  help='html template file extension.')
+    parser.add_argument('options',             type=str,  help='json dictionary with options for this program. (see vimwiki_markdown -h)')
+    parser.add_argument('--extension',         type=str,  default='.md', help='input file extension. (default: .md)')
+    parser.add_argument('--force',             action='store_true', help='convert every page, ignoring the build manifest.')
+    parser.add_argument('--jobs', '-j',        type=int,  default=1, help='number of worker processes, 0 means one per cpu. (default: 1)')
+
+    args = parser.parse_args(argv)
+    # the link index stores absolute sources, relative_to needs absolute roots to match them
+    args.wiki_root = Path(os.path.abspath(args.wiki_root))
+    args.output_root = Path(os.path.abspath(args.output_root))
+
+    options = {}
+    if args.options:
+        options = json.loads(args.options)
+    enable_trace(options)
+    set_fsync_policy(options)
+    applied_defaults.clear()
+
+    manifest = BuildManifest(
+            args.output_root,
+            options,
+            args.template_path,
+            args.template_default,
+            args.template_ext,
+            force=args.force
+    )
+    assets = open_asset_store(args.output_root, options)
+    links = open_link_index(args.output_root, options)
+    search = open_search_index(args.output_root, options)
+    headings = open_heading_index(args.output_root, options)
+    if any(index is not None and index.created for index in (links, search, headings)):
+        # pages skipped by the manifest would be missing from a new index
+        manifest.force = True
+
+    start = time.perf_counter()
+
+    with open_batch_io(options):
+        jobs = [batch_job(args.wiki_root, args.output_root, input_file)
+                for input_file in find_wiki_pages(args.wiki_root, args.extension, args.output_root)]
+
+        if links is not None:
+            links.prune({os.path.abspath(job[0]) for job in jobs})
+
+        templates = (args.template_path, args.template_default, args.template_ext)
+        processes = args.jobs or os.cpu_count() or 1
+        if processes > 1 and len(jobs) > 1:
+            pages, backlinks, counts = convert_pages_parallel(jobs, options, templates, manifest, assets, processes,
+                                                              links, search, headings)
+        else:
+            md = converter_pool.get(options, args.wiki_root, args.output_root)
+            pages, counts = convert_pages(jobs, md, templates, manifest, assets, links, search, headings)
+            backlinks = 0
+            if links is not None:
+                backlinks = update_backlinks(md, links, templates, args.wiki_root, args.output_root)
+
+        copy_css(args.output_root, options, assets)
+        copied = assets.finish()
+        assets.close()
+
+        shards = 0
+        if search is not None:
+            search.prune({os.path.abspath(job[0]) for job in jobs})
+            shards = search.write()
+
+        generated = 0
+        if headings is not None:
+            headings.prune({os.path.abspath(job[0]) for job in jobs})
+            generated = headings.write(templates)
+
+    # pages are recorded when their write is queued, closing batch io raises if one failed
+    manifest.save()
+
+    elapsed = time.perf_counter() - start
+    rate = (pages + manifest.rendered + manifest.skipped) / elapsed if elapsed > 0 else 0.0
+    print(f'converted {pages} pages, {manifest.skipped} up to date, in {elapsed:.2f}s ({rate:.1f} pages/sec)')
+    if manifest.rendered:
+        print(f'rendered {manifest.rendered} pages from cached content')
+    if backlinks:
+        print(f'updated backlinks of {backlinks} pages')
+    if copied:
+        print(f'copied {copied} assets')
+    if shards:
+        print(f'wrote {shards} search index shards')
+    if generated:
+        print(f'wrote {generated} generated index pages')
+    for name, (hits, misses) in counts.items():
+        if hits or misses:
+            print(f'{name} cache: {hits} hits, {misses} misses')
+    if links is not None:
+        for source, target in links.broken_links():
+            print(f'broken link in {source}: {target}')
+    if trace is not None:
+        print_trace_summary(trace)
+
+
+def rebuild_dependents_main(argv):
+    parser = argparse.ArgumentParser(prog='vimwiki_markdown rebuild-dependents',
+                                     description='Render again the pages that use a template, from their cached content.')
+    parser.add_argument('template',            type=Path, help='the changed template, a file or a name in template_path.')
+    parser.add_argument('wiki_root',           type=Path, help='full path to the wiki source directory.')
+    parser.add_argument('output_root',         type=Path, help='full path to the html output root directory.')
+    parser.add_argument('template_path',       type=Path, help='full path to directory with html templates.')
+    parser.add_argument('template_default',    type=str,  help='default html template file name. (without extension).')
+    parser.add_argument('template_ext',        type=str,  help='html template file extension.')
+    parser.add_argument('options',             type=str,  help='json dictionary with options for this program. (see vimwiki_markdown -h)')
+
+    args = parser.parse_args(argv)
+    # the manifest is keyed by absolute paths
+    args.wiki_root = Path(os.path.abspath(args.wiki_root))
+    args.output_root = Path(os.path.abspath(args.output_root))
+    args.template_path = Path(os.path.abspath(args.template_path))
+
+    options = {}
+    if args.options:
+        options = json.loads(args.options)
+    enable_trace(options)
+    set_fsync_policy(options)
+    applied_defaults.clear()
+
+    tpl_file = args.template
+    if not tpl_file.is_file():
+        tpl_file = args.template_path / (str(args.template) + args.template_ext)
+
+    manifest = BuildManifest(
+            args.output_root,
+            options,
+            args.template_path,
+            args.template_default,
+            args.template_ext
+    )
+    assets = open_asset_store(args.output_root, options)
+    links = open_link_index(args.output_root, options)
+    search = open_search_index(args.output_root, options)
+    headings = open_heading_index(args.output_root, options)
+    templates = (args.template_path, args.template_default, args.template_ext)
+
+    start = time.perf_counter()
+
+    pages = 0
+    with open_batch_io(options):
+        jobs = [batch_job(args.wiki_root, args.output_root, input_file)
+                for input_file in sorted(manifest.pages_using_template(tpl_file)) if is_file(input_file)]
+
+        if headings is not None and os.path.abspath(tpl_file) == str(args.template_path / (
+                args.template_default + args.template_ext)):
+            headings.template_changed()
+
+        # markdown is only set up for pages without cached content
+        md = None
+        for job in read_ahead(jobs):
+            input_file, output_dir, rel_root_path = job
+            staleness = manifest.staleness(input_file, page_output_file(input_file, output_dir), rel_root_path)
+            if staleness is None:
+                manifest.skipped += 1
+            elif not (staleness == 'template' and rerender_cached_page(*job, *templates, manifest, links)):
+                if md is None:
+                    md = converter_pool.get(options, args.wiki_root, args.output_root)
+                rebind_markdown_converter(md, input_file.parent, output_dir)
+                if convert_page(md, input_file, output_dir, rel_root_path, *templates, manifest, links, assets,
+                                search, headings):
+                    pages += 1
+
+        copy_css(args.output_root, options, assets)
+        assets.finish()
+        assets.close()
+        if search is not None:
+            search.write()
+        if headings is not None:
+            headings.write(templates)
+
+    # pages are recorded when their write is queued, closing batch io raises if one failed
+    manifest.save()
+
+    elapsed = time.perf_counter() - start
+    print(f'rendered {manifest.rendered} pages from cached content, converted {pages}, '
+          f'{manifest.skipped} up to date, in {elapsed:.2f}s')
+    if trace is not None:
+        print_trace_summary(trace)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def print_trace_summary(trace: Trace, top: int = 5):
+    summary = trace.summary()
+    trace.write({'summary': summary})
+    print('slowest stages:')
+    for entry in summary['stages'][:top]:
+        print(f"    {entry['stage']}: {entry['seconds']:.3f}s ({entry['calls']} calls)")
+    print('slowest pages:')
+    for entry in summary['slowest_pages'][:top]:
+        print(f"    {entry['page']}: {entry['seconds'] * 1000:.1f} ms")
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def forget_page(input_file: Path,
+                output_dir: Path,
+                manifest: BuildManifest,
+                links: Optional[LinkIndex],
+                search: Optional[SearchIndex],
+                headings: Optional[HeadingIndex]) -> bool:
+    """Drop a deleted page from the manifest and indexes and remove its html.
+
+    Returns False if the page was never converted.
+    """
+    if manifest.pages.get(os.path.abspath(input_file)) is None:
+        return False
+    output_file = page_output_file(input_file, output_dir)
+    manifest.forget(input_file)
+    for index in (links, search, headings):
+        if index is not None:
+            index.forget(index.page_key(output_file))
+    with contextlib.suppress(FileNotFoundError):
+        output_file.unlink()
+    return True
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class PollingWatcher:
+    """Finds changed files by comparing mtimes, for systems without inotify."""
+
+    def __init__(self, trees: List[Path], files: List[Path], exclude: Path, interval: float):
+        self.trees = trees
+        self.files = files
+        self.exclude = os.path.abspath(exclude)
+        self.interval = interval
+        self.mtimes = self.scan()
+
+    def scan(self) -> Dict[str, int]:
+        mtimes = {}
+        paths = [str(f) for f in self.files]
+        for tree in self.trees:
+            for dirpath, dirnames, filenames in os.walk(tree):
+                dirnames[:] = [d for d in dirnames
+                               if not d.startswith('.') and os.path.abspath(os.path.join(dirpath, d)) != self.exclude]
+                paths.extend(os.path.join(dirpath, f) for f in filenames)
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return mtimes
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic())))
+            mtimes = self.scan()
+            changed = {Path(p) for p in set(mtimes) | set(self.mtimes) if mtimes.get(p) != self.mtimes.get(p)}
+            self.mtimes = mtimes
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class InotifyWatcher:
+    """Finds changed files with linux inotify, watching every directory of the trees."""
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    event_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, trees: List[Path], files: List[Path], exclude: Path):
+        # only needed here, and only available on linux
+        import ctypes
+        import ctypes.util
+        import struct
+
+        self.event_header = struct.Struct('iIII')
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.exclude = os.path.abspath(exclude)
+        self.watches: Dict[int, str] = {}
+        for tree in trees:
+            self.add_tree(str(tree))
+        for parent in {str(f.parent) for f in files}:
+            self.add_watch(parent)
+
+    def add_watch(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.event_mask)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def add_tree(self, root: str):
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and os.path.abspath(os.path.join(dirpath, d)) != self.exclude]
+            self.add_watch(dirpath)
+
+    def wait(self, timeout: Optional[float]) -> Set[Path]:
+        import select
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self.fd, 65536)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self.event_header.unpack_from(data, pos)
+            pos += self.event_header.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and os.path.abspath(path) != self.exclude:
+                    self.add_tree(path)
+                continue
+            changed.add(Path(path))
+        return changed
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def make_watcher(trees: List[Path], files: List[Path], exclude: Path, poll: Optional[float]):
+    if poll is None:
+        try:
+            return InotifyWatcher(trees, files, exclude)
+        except (OSError, AttributeError) as e:
+            eprint(f'inotify is not available ({e}), falling back to polling.')
+    return PollingWatcher(trees, files, exclude, poll or 1.0)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def watch_main(argv):
+    parser = argparse.ArgumentParser(prog='vimwiki_markdown watch',
+                                     description='Convert wiki pages whenever they, their templates or the css files change.')
+    parser.add_argument('wiki_root',           type=Path, help='full path to the wiki source directory.')
+    parser.add_argument('output_root',         type=Path, help='full path to the html output root directory.')
+    parser.add_argument('template_path',       type=Path, help='full path to directory with html templates.')
+    parser.add_argument('template_default',    type=str,  help='default html template file name. (without extension).')
+    parser.add_argument('template_ext',        type=str,  help='html template file extension.')
+    parser.add_argument('options',             type=str,  help='json dictionary with options for this program. (see vimwiki_markdown -h)')
+    parser.add_argument('--extension',         type=str,  default='.md', help='input file extension. (default: .md)')
+    parser.add_argument('--debounce',          type=float, default=0.05, help='seconds to wait for a burst of changes to settle. (default: %(default)s)')
+    parser.add_argument('--poll',              type=float, default=None, help='poll for changes every POLL seconds instead of using inotify.')
+
+    args = parser.parse_args(argv)
+    # the link index stores absolute sources, relative_to needs absolute roots to match them
+    args.wiki_root = Path(os.path.abspath(args.wiki_root))
+    args.output_root = Path(os.path.abspath(args.output_root))
+    # changed templates are looked up in the manifest by absolute path
+    args.template_path = Path(os.path.abspath(args.template_path))
+
+    options = {}
+    if args.options:
+        options = json.loads(args.options)
+    enable_trace(options)
+    set_fsync_policy(options)
+    applied_defaults.clear()
+
+    manifest = BuildManifest(
+            args.output_root,
+            options,
+            args.template_path,
+            args.template_default,
+            args.template_ext
+    )
+    templates = (args.template_path, args.template_default, args.template_ext)
+    css_sources = {os.path.abspath(css.split(':')[0]) for css in options.get('css_files', '').split(',') if css}
+
+    assets = open_asset_store(args.output_root, options)
+    links = open_link_index(args.output_root, options)
+    search = open_search_index(args.output_root, options)
+    headings = open_heading_index(args.output_root, options)
+    if any(index is not None and index.created for index in (links, search, headings)):
+        manifest.force = True
+
+    # bring the output up to date before waiting for changes
+    md = converter_pool.get(options, args.wiki_root, args.output_root)
+    with open_batch_io(options):
+        jobs = [batch_job(args.wiki_root, args.output_root, input_file)
+                for input_file in find_wiki_pages(args.wiki_root, args.extension, args.output_root)]
+        convert_pages(jobs, md, templates, manifest, assets, links, search, headings)
+    manifest.save()
+    manifest.force = False
+    copy_css(args.output_root, options, assets)
+    assets.finish()
+
+    trees = [args.wiki_root]
+    if args.template_path.is_dir():
+        trees.append(args.template_path)
+    watcher = make_watcher(trees, [Path(css) for css in css_sources], args.output_root, args.poll)
+
+    if links is not None:
+        links.prune({os.path.abspath(job[0]) for job in jobs})
+        update_backlinks(md, links, templates, args.wiki_root, args.output_root)
+    if search is not None:
+        search.prune({os.path.abspath(job[0]) for job in jobs})
+        search.write()
+    if headings is not None:
+        headings.prune({os.path.abspath(job[0]) for job in jobs})
+        headings.write(templates)
+    wiki_root = os.path.abspath(args.wiki_root)
+    template_dir = os.path.abspath(args.template_path)
+    output_root = os.path.abspath(args.output_root)
+    print(f'watching {args.wiki_root} for changes')
+
+    while True:
+        try:
+            changed = watcher.wait(None)
+            while True:
+                more = watcher.wait(args.debounce)
+                if not more:
+                    break
+                changed |= more
+        except KeyboardInterrupt:
+            break
+
+        pages: Set[str] = set()
+        css_changed = False
+        applied_defaults.clear()
+        for path in changed:
+            path_str = os.path.abspath(path)
+            if path_str in css_sources:
+                css_changed = True
+            elif os.path.dirname(path_str) == template_dir and path_str.endswith(args.template_ext):
+                pages.update(str(p) for p in manifest.pages_using_template(Path(path_str)))
+                if headings is not None and path_str == os.path.join(template_dir,
+                                                                     args.template_default + args.template_ext):
+                    headings.template_changed()
+            elif (path_str.endswith(args.extension)
+                    and path_str.startswith(wiki_root + os.sep)
+                    and not path_str.startswith(output_root + os.sep)):
+                pages.add(path_str)
+
+        for page in sorted(pages):
+            input_file, output_dir, rel_root_path = batch_job(Path(wiki_root), args.output_root, Path(page))
+            if not os.path.isfile(page):
+                if forget_page(input_file, output_dir, manifest, links, search, headings):
+                    print(f'removed {os.path.relpath(page, wiki_root)}')
+                continue
+            start = time.perf_counter()
+            rebind_markdown_converter(md, input_file.parent, output_dir)
+            skipped = manifest.skipped
+            rendered = manifest.rendered
+            try:
+                convert_page(md, input_file, output_dir, rel_root_path, *templates, manifest, links, assets, search,
+                             headings)
+            except Exception as e:
+                # keep watching, the page is converted again when it is fixed
+                eprint(f'failed to convert {os.path.relpath(page, wiki_root)}: {e}')
+                continue
+            if manifest.skipped == skipped:
+                elapsed = (time.perf_counter() - start) * 1000
+                action = 'rendered' if manifest.rendered != rendered else 'converted'
+                print(f'{action} {os.path.relpath(page, wiki_root)} in {elapsed:.0f} ms')
+        manifest.save()
+
+        if links is not None and pages:
+            backlinks = update_backlinks(md, links, templates, Path(wiki_root), args.output_root)
+            if backlinks:
+                print(f'updated backlinks of {backlinks} pages')
+
+        if css_changed:
+            copy_css(args.output_root, options, assets)
+        assets.finish()
+        if search is not None:
+            search.write()
+        if headings is not None:
+            headings.write(templates)
+
+    assets.close()
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def parse_flag(value: str) -> bool:
+    return value.strip().lower() not in ('', '0', 'false', 'no')
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def make_parser() -> argparse.ArgumentParser:
     options = textwrap.dedent(r'''
     the options are a json string with the following optional keys:
         markdown_extensions: string with comma separated python-markdown extensions to use.
@@ -430,6 +3419,44 @@ def main():
             default: None.
         copy_images: boolean (default true). if true will copy images in image links to the output directory.
             default: true.
+        asset_mode: how images and css files are put in the output, "copy", "hardlink" or "reflink".
+            links and reflinks fall back to copies where the filesystem does not support them.
+            default: "copy".
+        asset_threads: number of threads copying assets in batch and watch runs.
+            default: 4.
+        io_threads: number of threads reading page sources ahead in batch and watch runs, the html
+            is written on one more. this hides the latency of network filesystems, 0 turns it off.
+            default: 2.
+        fsync: when written html is flushed to disk, "never" leaves it to the os, "file" syncs
+            every page before it replaces the old one, "full" also syncs the directory.
+            default: "never".
+        large_page_size: pages larger than this many bytes are converted a few blocks at a time
+            and streamed to the output, 0 disables it. see "Large pages" in the readme.
+            default: 1048576.
+        heading_index: boolean, if true headings get ids and the headings of every page are recorded
+            in the output root. this fills in the %toc% template placeholder and writes index.html and
+            diary/diary.html when the wiki has no pages of its own for them.
+            default: false.
+        search_index: boolean, if true the words of every page are indexed for full text search,
+            written to the search directory of the output root along with a search.js client.
+            default: false.
+        link_index: boolean, if true links between pages are recorded in the output root.
+            this fills in the %backlinks% template placeholder and reports broken links in batch runs.
+            default: false.
+        highlight_cache: path to a cache file for highlighted code blocks, false disables the cache.
+            default: $XDG_CACHE_HOME/vimwiki_markdown/highlight.sqlite.
+        highlight_cache_size: size limit of the highlight cache in megabytes.
+            default: 64.
+        fragment_cache: path to a cache file for the converted content of pages, false disables the cache.
+            default: $XDG_CACHE_HOME/vimwiki_markdown/fragments.sqlite.
+        fragment_cache_size: size limit of the fragment cache in megabytes.
+            default: 256.
+        trace: path to a log file, time spent per stage and page is appended to it as json lines.
+            the VIMWIKI_MARKDOWN_TRACE environment variable does the same.
+            default: None.
+        trace_profile: directory for a cProfile dump of every page, only used with trace.
+            the VIMWIKI_MARKDOWN_PROFILE environment variable does the same.
+            default: None.
     example:
     {
         "markdown_extensions": "admonition",
@@ -439,7 +3466,7 @@ def main():
     ''')
 
     parser = argparse.ArgumentParser(description='Convert wiki markdown to html.', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('force',               type=bool, help='force conversion. (ignored, always forced)')
+    parser.add_argument('force',               type=parse_flag, help='force conversion. (0 converts only if the page or its template changed)')
     parser.add_argument('syntax',              type=str,  help='syntax to convert. (only markdown supported)')
     parser.add_argument('extension',           type=str,  help='input file extension.')
     parser.add_argument('output_dir',          type=Path, help='full path to the output directory.')
@@ -449,39 +3476,193 @@ def main():
     parser.add_argument('template_default',    type=str,  help='default html template file name. (without extension).')
     parser.add_argument('template_ext',        type=str,  help='html template file extension.')
     parser.add_argument('root_path',           type=str,  help=r'relative path from the output directory to the output root. (e.g. ../../)  ("-" means in root)')
-    parser.add_argument('options',             type=str,  help=f'json dictionary with options for this program. {options}')
+    parser.add_argument('options',             type=str,  help=f'json dictionary with options for this program. {options.replace("%", "%%")}')
+
+    return parser
 
-    args = parser.parse_args()
+
+#******************************************************************************
+#
+#******************************************************************************
+def convert_main(argv: List[str], pool: Optional[ConverterPool] = None) -> int:
+    """Convert one page as vimwiki asks for it, returns the exit status.
+
+    Passing a converter pool keeps the configured converters around
+    between calls.
+    """
+    start = time.perf_counter()
+    args = make_parser().parse_args(argv)
 
     rel_root_path = args.root_path if args.root_path != '-' else ""
     root_path = args.output_dir / rel_root_path
-    output_file = args.output_dir / Path(args.input_file.stem + '.html')
 
     options = {}
     if args.options:
         options = json.loads(args.options)
 
+    if enable_trace(options):
+        trace.add('parse_arguments', time.perf_counter() - start)
+    set_fsync_policy(options)
+    applied_defaults.clear()
+
     # Only markdown is supported
     if args.syntax != 'markdown':
         eprint('Unsupported syntax: ' + args.syntax)
-        sys.exit(1)
-
-    md = setup_markdown_converter(options, args.input_file.parent, args.output_dir)
+        return 1
 
-    placeholders, requested_template = process_input_file(md, args.input_file, rel_root_path)
-
-    template = try_read_html_template(
+    manifest = BuildManifest(
+            root_path,
+            options,
+            args.template_path,
+            args.template_default,
+            args.template_ext,
+            force=args.force
+    )
+    # a page refers to a few images at most, not worth starting threads for
+    assets = open_asset_store(root_path, options, threads=1)
+    search = open_search_index(root_path, options)
+    headings = open_heading_index(root_path, options)
+
+    if pool is None:
+        # a single run pays for every import, so return before importing
+        # markdown when the page is up to date, and leave out pygments
+        # when it has no code to highlight
+        output_file = page_output_file(args.input_file, args.output_dir)
+        staleness = manifest.staleness(args.input_file, output_file, rel_root_path)
+        if staleness == 'template' and rerender_cached_page(args.input_file,
+                                                            args.output_dir,
+                                                            rel_root_path,
+                                                            args.template_path,
+                                                            args.template_default,
+                                                            args.template_ext,
+                                                            manifest,
+                                                            open_link_index(root_path, options)):
+            staleness = None
+        if staleness is None:
+            manifest.save()
+            copy_css(root_path, options, assets)
+            assets.finish()
+            return 0
+        # a page saved from vim has a new body, so a fragment lookup would
+        # miss and storing it only costs the sqlite writes
+        md = setup_markdown_converter(dict(options, fragment_cache=False),
+                                      args.input_file.parent,
+                                      args.output_dir,
+                                      highlight=page_has_code(args.input_file))
+    else:
+        # the wiki root is as far above the page as the output root is above its html
+        md = pool.get(options,
+                      args.input_file.parent / rel_root_path,
+                      root_path,
+                      args.input_file.parent,
+                      args.output_dir)
+
+    converted = convert_page(
+            md,
+            args.input_file,
+            args.output_dir,
+            rel_root_path,
             args.template_path,
             args.template_default,
             args.template_ext,
-            requested_template
-    ) or apply_defaults(root_path)
+            manifest,
+            open_link_index(root_path, options),
+            assets,
+            search,
+            headings
+    )
+    manifest.save()
+    if converted:
+        copy_css(root_path, options, assets)
+    assets.finish()
+    if search is not None:
+        search.write()
+    if headings is not None:
+        headings.write((args.template_path, args.template_default, args.template_ext))
+    return 0
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def handle_conversion_request(request: Dict, pool: ConverterPool) -> Dict:
+    """Runs one client request: {"cwd": ..., "argv": [...]} -> {"status": ..., "stdout": ..., "stderr": ...}"""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            os.chdir(request.get('cwd', '/'))
+            status = convert_main(request['argv'], pool)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            eprint(f'{type(e).__name__}: {e}')
+            status = 1
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
 
-    html = render_template(template, placeholders)
 
-    write_to_file(output_file, html)
+#******************************************************************************
+#
+#******************************************************************************
+def serve_main(argv):
+    import signal
+    import socketserver
+    from vimwiki_markdown_client import default_socket_path
+
+    parser = argparse.ArgumentParser(prog='vimwiki_markdown serve',
+                                     description='Keep converters warm and convert pages sent by vimwiki_markdown_client.')
+    parser.add_argument('--socket',            type=str,  default=default_socket_path(), help='unix socket to listen on. (default: %(default)s)')
+    parser.add_argument('--converters',        type=int,  default=8, help='configured converters to keep, one per wiki and options. (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    # pay for the pygments import up front instead of on the first page
+    setup_markdown_converter({}, Path(), Path()).convert('```python\npass\n```')
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    converter_pool.max_size = args.converters
+
+    class ConversionRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.read().decode('utf-8'))
+            response = handle_conversion_request(request, converter_pool)
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+
+    with socketserver.UnixStreamServer(args.socket, ConversionRequestHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+commands = {
+    'batch': batch_main,
+    'rebuild-dependents': rebuild_dependents_main,
+    'serve': serve_main,
+    'watch': watch_main,
+}
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def main():
+    # print(sys.argv)
+    # exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
 
-    copy_css(root_path, options)
+    sys.exit(convert_main(sys.argv[1:]))
 
 
 #******************************************************************************
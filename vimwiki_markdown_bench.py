@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks for vimwiki_markdown.
+
+Generates a reproducible synthetic wiki, times a full build and single
+page conversions, and writes the results as json. A saved result can be
+passed as a baseline to fail on regressions. The import time of the
+module is checked against a fixed budget.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import markdown
+import pygments
+import vimwiki_markdown
+
+
+#******************************************************************************
+#
+#******************************************************************************
+words = ('wiki lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud').split()
+
+code_samples = {
+    'python': 'def f{n}(x):\n    """doc"""\n    return [i * {n} for i in range(x) if i % 3]\n',
+    'c': 'int f{n}(int x) {{\n    return x * {n}; /* c */\n}}\n',
+    'bash': 'for f in *.md; do\n    echo "$f" {n} | grep -v x\ndone\n',
+}
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def generate_wiki(root: Path,
+                  pages: int,
+                  paragraphs: int,
+                  code_blocks: int,
+                  images: int,
+                  links: int,
+                  seed: int) -> List[Path]:
+    """Write a synthetic wiki below root, the same for the same arguments."""
+    rnd = random.Random(seed)
+    names = [f'dir{i % 10}/page{i}' if i % 3 else f'page{i}' for i in range(pages)]
+
+    (root / 'img').mkdir(parents=True, exist_ok=True)
+    for i in range(max(images, 1)):
+        with open(root / 'img' / f'image{i}.png', 'wb') as f:
+            f.write(bytes(rnd.getrandbits(8) for _ in range(2048)))
+
+    files = []
+    for i, name in enumerate(names):
+        depth = name.count('/')
+        up = '../' * depth
+        blocks = [f'%title Page {i}\n', f'# Page {i}\n']
+        for p in range(paragraphs):
+            text = ' '.join(rnd.choice(words) for _ in range(60))
+            if p < links:
+                text += ' see [page](' + up + rnd.choice(names) + ')'
+            if p < images:
+                text += f' ![image]({up}img/image{rnd.randrange(images)}.png)'
+            blocks.append(text + '\n')
+            if p < code_blocks:
+                lang = rnd.choice(sorted(code_samples))
+                blocks.append(f'```{lang}\n' + code_samples[lang].format(n=rnd.randrange(1000)) * 5 + '```\n')
+
+        path = root / (name + '.md')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('\n'.join(blocks))
+        files.append(path)
+    return files
+
+
+#******************************************************************************
+#
+#******************************************************************************
+class StageTimer:
+    """Times the main conversion stages by wrapping the module functions."""
+
+    stages = ('process_input_file', 'md.convert', 'render_template', 'write_to_file', 'copy_asset')
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {stage: 0.0 for stage in self.stages}
+        self.calls: Dict[str, int] = {stage: 0 for stage in self.stages}
+        self.originals = {}
+
+    def wrap(self, stage: str, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+        return timed
+
+    def __enter__(self):
+        for stage in ('process_input_file', 'render_template', 'write_to_file', 'copy_asset'):
+            self.originals[stage] = getattr(vimwiki_markdown, stage)
+            setattr(vimwiki_markdown, stage, self.wrap(stage, self.originals[stage]))
+        self.originals['md.convert'] = markdown.Markdown.convert
+        markdown.Markdown.convert = self.wrap('md.convert', markdown.Markdown.convert)
+        return self
+
+    def __exit__(self, *exc):
+        markdown.Markdown.convert = self.originals.pop('md.convert')
+        for stage, func in self.originals.items():
+            setattr(vimwiki_markdown, stage, func)
+        self.originals = {}
+
+    def results(self) -> Dict:
+        # md.convert runs inside process_input_file, report the reading part on its own
+        seconds = dict(self.seconds)
+        seconds['process_input_file'] -= seconds['md.convert']
+        return {stage: {'calls': self.calls[stage], 'seconds': round(seconds[stage], 6)}
+                for stage in self.stages}
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def bench_full_build(wiki: Path, output: Path, templates: Path, options: Dict, timer: StageTimer) -> Dict:
+    shutil.rmtree(output, ignore_errors=True)
+    argv = [str(wiki), str(output), str(templates), 'default', '.tpl', json.dumps(options), '--force']
+    start = time.perf_counter()
+    # keep stdout for the json results
+    with timer, contextlib.redirect_stdout(sys.stderr):
+        vimwiki_markdown.batch_main(argv)
+    elapsed = time.perf_counter() - start
+    pages = sum(1 for _ in wiki.rglob('*.md'))
+    return {'pages': pages, 'seconds': round(elapsed, 6), 'pages_per_sec': round(pages / elapsed, 3)}
+
+
+def bench_single_page(wiki: Path, output: Path, templates: Path, options: Dict, repeat: int) -> Dict:
+    """Convert a page in a fresh interpreter, as vim does on every save."""
+    page = wiki / 'dir1' / 'page1.md'
+    argv = [sys.executable, vimwiki_markdown.__file__,
+            '1', 'markdown', '.md', str(output / 'dir1'), str(page), 'style.css',
+            str(templates), 'default', '.tpl', '../', json.dumps(options)]
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'runs': repeat,
+            'median_ms': round(statistics.median(timings), 3),
+            'min_ms': round(min(timings), 3)}
+
+
+# modules a single page conversion should only import when it needs them
+lazy_imports = ('markdown', 'pygments', 'sqlite3', 'multiprocessing', 'socketserver', 'cProfile')
+
+
+def bench_startup(repeat: int) -> Dict:
+    """Import vimwiki_markdown in a fresh interpreter, as vim does for every page."""
+    timings = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import vimwiki_markdown'],
+                              cwd=Path(vimwiki_markdown.__file__).parent,
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        imported = {}
+        for line in proc.stderr.splitlines():
+            if line.startswith('import time:') and not line.endswith('package'):
+                _, cumulative, name = line[len('import time:'):].split('|')
+                imported[name.strip()] = int(cumulative)
+        timings.append(imported['vimwiki_markdown'] / 1000)
+    return {'runs': repeat,
+            'import_ms': round(min(timings), 3),
+            'eager_imports': sorted(name for name in lazy_imports if name in imported)}
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def check_startup(startup: Dict, budget_ms: float) -> List[str]:
+    problems = [f'startup: {name} is imported with vimwiki_markdown' for name in startup['eager_imports']]
+    if startup['import_ms'] > budget_ms:
+        problems.append(f'startup.import_ms: {startup["import_ms"]} over the budget of {budget_ms}')
+    return problems
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regressions of results against baseline, larger than tolerance (a fraction)."""
+    checks = [
+        ('full_build.pages_per_sec', results['full_build']['pages_per_sec'], baseline['full_build']['pages_per_sec'], True),
+        ('single_page.median_ms', results['single_page']['median_ms'], baseline['single_page']['median_ms'], False),
+    ]
+    regressions = []
+    for name, value, base, higher_is_better in checks:
+        change = (value - base) / base if base else 0.0
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f'{name}: {base} -> {value} ({change:+.1%})')
+    return regressions
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vimwiki_markdown on a synthetic wiki.')
+    parser.add_argument('--pages',       type=int,   default=200, help='number of pages. (default: %(default)s)')
+    parser.add_argument('--paragraphs',  type=int,   default=20,  help='paragraphs per page. (default: %(default)s)')
+    parser.add_argument('--code-blocks', type=int,   default=3,   help='fenced code blocks per page. (default: %(default)s)')
+    parser.add_argument('--images',      type=int,   default=2,   help='images per page. (default: %(default)s)')
+    parser.add_argument('--links',       type=int,   default=5,   help='links per page. (default: %(default)s)')
+    parser.add_argument('--seed',        type=int,   default=1,   help='random seed of the generated wiki. (default: %(default)s)')
+    parser.add_argument('--repeat',      type=int,   default=20,  help='single page conversions to time. (default: %(default)s)')
+    parser.add_argument('--options',     type=str,   default='{}',
+                        help='json options passed to the converter. (default: %(default)s)')
+    parser.add_argument('--output',      type=Path,  help='write the results to this json file.')
+    parser.add_argument('--baseline',    type=Path,  help='compare against the results in this json file.')
+    parser.add_argument('--tolerance',   type=float, default=0.15, help='allowed regression as a fraction. (default: %(default)s)')
+    parser.add_argument('--workdir',     type=Path,  help='directory for the generated wiki. (default: a temporary directory)')
+    parser.add_argument('--import-budget', type=float, default=60.0,
+                        help='fail when importing vimwiki_markdown takes longer, in ms. (default: %(default)s)')
+
+    args = parser.parse_args()
+    options = json.loads(args.options)
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix='vimwiki_markdown_bench_'))
+    # the default caches start empty every run instead of using the user's
+    shutil.rmtree(workdir / 'cache', ignore_errors=True)
+    os.environ['XDG_CACHE_HOME'] = str(workdir / 'cache')
+    wiki = workdir / 'wiki'
+    output = workdir / 'html'
+    templates = workdir / 'templates'
+    try:
+        shutil.rmtree(wiki, ignore_errors=True)
+        generate_wiki(wiki, args.pages, args.paragraphs, args.code_blocks, args.images, args.links, args.seed)
+        templates.mkdir(parents=True, exist_ok=True)
+        with open(templates / 'default.tpl', 'w') as f:
+            f.write(vimwiki_markdown.default_template)
+
+        timer = StageTimer()
+        full_build = bench_full_build(wiki, output, templates, options, timer)
+        single_page = bench_single_page(wiki, output, templates, options, args.repeat)
+        startup = bench_startup(args.repeat)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'config': {
+            'pages': args.pages,
+            'paragraphs': args.paragraphs,
+            'code_blocks': args.code_blocks,
+            'images': args.images,
+            'links': args.links,
+            'seed': args.seed,
+            'options': options,
+        },
+        'versions': {
+            'python': platform.python_version(),
+            'markdown': markdown.__version__,
+            'pygments': pygments.__version__,
+        },
+        'full_build': full_build,
+        'single_page': single_page,
+        'startup': startup,
+        'stages': timer.results(),
+    }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+    regressions = check_startup(startup, args.import_budget)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions += compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'regression: {regression}', file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+#******************************************************************************
+#
+#******************************************************************************
+if __name__ == '__main__':
+    main()
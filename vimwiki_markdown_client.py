@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Thin client for `vimwiki_markdown serve`.
+
+Takes the same arguments as vimwiki_markdown, sends them to the running
+server and exits with its status. Only the standard library is imported
+here so the client starts fast. When no server is running the page is
+converted in this process instead.
+"""
+import json
+import os
+import socket
+import sys
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def default_socket_path() -> str:
+    if 'VIMWIKI_MARKDOWN_SOCKET' in os.environ:
+        return os.environ['VIMWIKI_MARKDOWN_SOCKET']
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, f'vimwiki_markdown-{os.getuid()}.sock')
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def send_request(socket_path: str, argv) -> dict:
+    request = json.dumps({'cwd': os.getcwd(), 'argv': argv}).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+#******************************************************************************
+#
+#******************************************************************************
+def main():
+    argv = sys.argv[1:]
+    try:
+        response = send_request(default_socket_path(), argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        import vimwiki_markdown
+        sys.exit(vimwiki_markdown.convert_main(argv))
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['status'])
+
+
+#******************************************************************************
+#
+#******************************************************************************
+if __name__ == '__main__':
+    main()